@@ -1,6 +1,11 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, division, print_function
 
+import copy
+import difflib
+import gc
+import hashlib
+import itertools
 import json
 import os
 import re
@@ -11,19 +16,25 @@ from collections import defaultdict
 from concurrent.futures import ProcessPoolExecutor, as_completed
 from os.path import isdir, join
 from tqdm import tqdm
-from functools import partial
+from functools import partial, wraps
 
 
 import requests
 import zstandard
 from conda_index.index import _apply_instructions
 from get_license_family import get_license_family
-from packaging.version import parse as parse_version
 from patch_yaml_utils import (
     CB_PIN_REGEX,
     _relax_exact,
     pad_list,
+    DEFAULT_RULE_SET,
+    PatchJournal,
+    filenames_matched_by_artifact_rules,
+    filenames_possibly_matched,
+    parse_dep_spec,
     patch_yaml_edit_index,
+    rule_fingerprint,
+    version_key,
 )
 from show_diff import show_record_diffs
 
@@ -318,6 +329,66 @@ OSX_SDK_FIXES = {
 }
 
 
+class _PythonPatchJournal:
+    """Adds the changes that the Python patches make to the RecordOverlay
+    records of an index to a PatchJournal, with the name of the function
+    that made each change as its source.
+
+    The original record of an overlay holds its values from before any
+    patch, so a record is only copied once a journaled function changes it.
+    """
+
+    __slots__ = ("journal", "_fns", "_before")
+
+    def __init__(self, journal, index):
+        self.journal = journal
+        self._fns = {id(record): fn for fn, record in index.items()}
+        # the records as of their last flush
+        self._before = {}
+
+    def tracks(self, record):
+        return isinstance(record, RecordOverlay) and id(record) in self._fns
+
+    def flush(self, record, source):
+        """Add the changes to record since the last flush to the journal."""
+        before = self._before.get(id(record), record.base)
+        if not record.changed and before is record.base:
+            return
+        self.journal.add_changes(self._fns[id(record)], before, record, source)
+        self._before[id(record)] = self.journal.snapshot(record)
+
+    def flush_all(self, index, source):
+        for record in index.values():
+            self.flush(record, source)
+
+
+def _journaled(func):
+    """Journal the changes that a Python patch function makes to the record
+    passed to it under the name of the function, when it is called with a
+    _PythonPatchJournal as python_journal."""
+
+    @wraps(func)
+    def _wrapper(*args, python_journal=None, **kwargs):
+        record = None
+        if python_journal is not None:
+            record = next((arg for arg in args if python_journal.tracks(arg)), None)
+        if record is None:
+            return func(*args, **kwargs)
+        # the changes made so far are those of the calling function
+        python_journal.flush(record, "_gen_new_index_per_key")
+        try:
+            return func(*args, **kwargs)
+        finally:
+            python_journal.flush(record, func.__name__)
+
+    return _wrapper
+
+
+# imported from patch_yaml_utils, where the rules use it too
+_relax_exact = _journaled(_relax_exact)
+
+
+@_journaled
 def _add_pybind11_abi_constraint(fn, record):
     """the pybind11-abi package uses the internals version
 
@@ -343,17 +414,17 @@ def _add_pybind11_abi_constraint(fn, record):
 
     prior to 2.2.0 we set it to 0
     """
-    ver = parse_version(record["version"])
+    ver = version_key(record["version"])
 
-    if ver < parse_version("2.2.0"):
+    if ver < version_key("2.2.0"):
         abi_ver = "0"
-    elif ver < parse_version("2.2.4"):
+    elif ver < version_key("2.2.4"):
         abi_ver = "1"
-    elif ver < parse_version("2.3.0"):
+    elif ver < version_key("2.3.0"):
         abi_ver = "2"
-    elif ver < parse_version("2.5.0"):
+    elif ver < version_key("2.5.0"):
         abi_ver = "3"
-    elif ver <= parse_version("2.6.1"):
+    elif ver <= version_key("2.6.1"):
         abi_ver = "4"
     else:
         # past this we should have a constrains there already
@@ -375,10 +446,16 @@ def _add_pybind11_abi_constraint(fn, record):
     record["constrains"] = constrains
 
 
+@_journaled
 def _fix_libgfortran(fn, record):
     depends = record.get("depends", ())
     dep_idx = next(
-        (q for q, dep in enumerate(depends) if dep.split(" ")[0] == "libgfortran"), None
+        (
+            q
+            for q, dep in enumerate(depends)
+            if parse_dep_spec(dep).name == "libgfortran"
+        ),
+        None,
     )
     if (
         dep_idx is not None
@@ -408,10 +485,12 @@ def _fix_libgfortran(fn, record):
             record["depends"] = depends
 
 
+@_journaled
 def _set_osx_virt_min(fn, record, min_vers):
     rconst = record.get("constrains", ())
     dep_idx = next(
-        (q for q, dep in enumerate(rconst) if dep.split(" ")[0] == "__osx"), None
+        (q for q, dep in enumerate(rconst) if parse_dep_spec(dep).name == "__osx"),
+        None,
     )
     run_constrained = list(rconst)
     if dep_idx is None:
@@ -420,22 +499,25 @@ def _set_osx_virt_min(fn, record, min_vers):
         record["constrains"] = run_constrained
 
 
+@_journaled
 def _fix_libcxx(fn, record):
     record_name = record["name"]
     if record_name not in ["cctools", "ld64", "llvm-lto-tapi"]:
         return
     depends = record.get("depends", ())
     dep_idx = next(
-        (q for q, dep in enumerate(depends) if dep.split(" ")[0] == "libcxx"), None
+        (q for q, dep in enumerate(depends) if parse_dep_spec(dep).name == "libcxx"),
+        None,
     )
     if dep_idx is not None:
-        dep_parts = depends[dep_idx].split(" ")
+        dep_parts = parse_dep_spec(depends[dep_idx]).parts
         if len(dep_parts) >= 2 and dep_parts[1] == "4.0.1":
             # catches all of 4.*
             depends[dep_idx] = "libcxx >=4.0.1"
             record["depends"] = depends
 
 
+@_journaled
 def _extract_and_remove_vc_feature(record):
     features = record.get("features", "").split()
     vc_features = tuple(f for f in features if f.startswith("vc"))
@@ -451,7 +533,7 @@ def _extract_and_remove_vc_feature(record):
 
 
 def has_dep(record, name):
-    return any(dep.split(" ")[0] == name for dep in record.get("depends", ()))
+    return any(parse_dep_spec(dep).name == name for dep in record.get("depends", ()))
 
 
 def get_python_abi(version, subdir, build=None):
@@ -483,18 +565,22 @@ def get_python_abi(version, subdir, build=None):
 
 
 # Workaround for https://github.com/conda/conda-build/pull/3868
+@_journaled
 def remove_python_abi(record):
     if record["name"] in ["python", "python_abi", "pypy"]:
         return
     if not has_dep(record, "python_abi"):
         return
     depends = record.get("depends", [])
-    record["depends"] = [dep for dep in depends if dep.split(" ")[0] != "python_abi"]
+    record["depends"] = [
+        dep for dep in depends if parse_dep_spec(dep).name != "python_abi"
+    ]
 
 
 changes = set([])
 
 
+@_journaled
 def add_python_abi(record, subdir):
     record_name = record["name"]
     # Make existing python and python-dependent packages conflict with pypy
@@ -518,7 +604,7 @@ def add_python_abi(record, subdir):
         ver_relax_found = False
 
         for dep in record.get("depends", []):
-            dep_split = dep.split(" ")
+            dep_split = parse_dep_spec(dep).parts
             if dep_split[0] == "python":
                 if len(dep_split) == 3:
                     continue
@@ -550,8 +636,14 @@ def add_python_abi(record, subdir):
         record["constrains"] = new_constrains
 
 
-def _gen_new_index_per_key(index, subdir, index_key="", verbose=False):
-    """Mutates the index by adjusting the values directly."""
+def _gen_new_index_per_key(
+    index, subdir, index_key="", verbose=False, python_journal=None
+):
+    """Mutates the index by adjusting the values directly.
+
+    If python_journal is a _PythonPatchJournal, the changes made by the
+    patch functions it is passed to are journaled under their names.
+    """
     # deal with windows vc features
     if subdir.startswith("win-"):
         python_vc_deps = {
@@ -576,7 +668,9 @@ def _gen_new_index_per_key(index, subdir, index_key="", verbose=False):
                     record["depends"] = depends
             elif "vc" in record.get("features", ""):
                 # remove vc from the features key
-                vc_version = _extract_and_remove_vc_feature(record)
+                vc_version = _extract_and_remove_vc_feature(
+                    record, python_journal=python_journal
+                )
                 if vc_version:
                     # add a vc dependency
                     if not any(d.startswith("vc") for d in record["depends"]):
@@ -604,9 +698,9 @@ def _gen_new_index_per_key(index, subdir, index_key="", verbose=False):
 
         if record.get("timestamp", 0) < 1604417730000:
             if subdir == "noarch":
-                remove_python_abi(record)
+                remove_python_abi(record, python_journal=python_journal)
             else:
-                add_python_abi(record, subdir)
+                add_python_abi(record, subdir, python_journal=python_journal)
 
         # add track_features to old python_abi pypy packages
         if (
@@ -620,7 +714,7 @@ def _gen_new_index_per_key(index, subdir, index_key="", verbose=False):
         new_deps = []
         changed = False
         for dep in record.get("depends", []):
-            dep_split = dep.split(" ")
+            dep_split = parse_dep_spec(dep).parts
             if (
                 len(dep_split) == 2
                 and dep_split[1].startswith("=")
@@ -644,12 +738,12 @@ def _gen_new_index_per_key(index, subdir, index_key="", verbose=False):
         if (
             record_name in ["pybind11", "pybind11-global"]
             # this version has a constraint sometimes
-            and (parse_version(record["version"]) <= parse_version("2.6.1"))
+            and (version_key(record["version"]) <= version_key("2.6.1"))
             and not any(
                 c.startswith("pybind11-abi ") for c in record.get("constrains", [])
             )
         ):
-            _add_pybind11_abi_constraint(fn, record)
+            _add_pybind11_abi_constraint(fn, record, python_journal=python_journal)
 
         ############################################
         # Compilers, Runtimes and Related Patches
@@ -659,8 +753,8 @@ def _gen_new_index_per_key(index, subdir, index_key="", verbose=False):
             record_name == "vs2015_runtime"
             and record.get("timestamp", 0) < 1633470721000
         ):
-            pversion = parse_version(record["version"])
-            vs2019_version = parse_version("14.29.30037")
+            pversion = version_key(record["version"])
+            vs2019_version = version_key("14.29.30037")
             if pversion < vs2019_version:
                 # make these conflict with ucrt
                 new_constrains = record.get("constrains", [])
@@ -678,7 +772,7 @@ def _gen_new_index_per_key(index, subdir, index_key="", verbose=False):
         if record_name in llvm_pkgs:
             new_constrains = record.get("constrains", [])
             version = record["version"]
-            if parse_version(version) < parse_version("17.0.0.a0"):
+            if version_key(version) < version_key("17.0.0.a0"):
                 for pkg in llvm_pkgs:
                     if record_name == pkg:
                         continue
@@ -693,7 +787,12 @@ def _gen_new_index_per_key(index, subdir, index_key="", verbose=False):
                 record["constrains"] = new_constrains
 
         if record_name == "gcc_impl_{}".format(subdir):
-            _relax_exact(fn, record, "binutils_impl_{}".format(subdir))
+            _relax_exact(
+                fn,
+                record,
+                "binutils_impl_{}".format(subdir),
+                python_journal=python_journal,
+            )
 
         # some symlinks changed in gfortran, so we need to adjust things
         # plus we missed a key version constraint
@@ -704,12 +803,17 @@ def _gen_new_index_per_key(index, subdir, index_key="", verbose=False):
 
         # make sure the libgfortran version is bound from 3 to 4 for osx
         if subdir == "osx-64":
-            _fix_libgfortran(fn, record)
-            _fix_libcxx(fn, record)
+            _fix_libgfortran(fn, record, python_journal=python_journal)
+            _fix_libcxx(fn, record, python_journal=python_journal)
 
             full_pkg_name = fn.replace(".tar.bz2", "")
             if full_pkg_name in OSX_SDK_FIXES:
-                _set_osx_virt_min(fn, record, OSX_SDK_FIXES[full_pkg_name])
+                _set_osx_virt_min(
+                    fn,
+                    record,
+                    OSX_SDK_FIXES[full_pkg_name],
+                    python_journal=python_journal,
+                )
 
         # when making the glibc 2.28 sysroots, we found we needed to go back
         # and add the current repodata hack packages to the cos7 sysroots
@@ -841,9 +945,17 @@ def _gen_new_index_per_key(index, subdir, index_key="", verbose=False):
         for llvm in ["libllvm8", "libllvm9"]:
             if any(dep.startswith(llvm) for dep in deps):
                 if record_name not in llvm_pkgs:
-                    _relax_exact(fn, record, llvm, max_pin="x.x")
+                    _relax_exact(
+                        fn, record, llvm, max_pin="x.x", python_journal=python_journal
+                    )
                 else:
-                    _relax_exact(fn, record, llvm, max_pin="x.x.x")
+                    _relax_exact(
+                        fn,
+                        record,
+                        llvm,
+                        max_pin="x.x.x",
+                        python_journal=python_journal,
+                    )
 
         # Properly depend on clangdev 5.0.0 flang* for flang 5.0
         if record_name == "flang":
@@ -880,11 +992,285 @@ def _gen_new_index_per_key(index, subdir, index_key="", verbose=False):
         #         instructions["packages"][fn]["depends"] = depends
 
 
-def _patch_indexes(repodata, subdir, verbose=False):
+# keys that differ between the .tar.bz2 and .conda artifacts of a build
+ARTIFACT_KEYS = {"md5", "sha256", "size"}
+
+
+def _metadata(record):
+    return {k: v for k, v in record.items() if k not in ARTIFACT_KEYS}
+
+
+def _find_twins(repodata, subdir):
+    """Map the .conda filenames to the .tar.bz2 filenames of the same build
+    whose records only differ in their ARTIFACT_KEYS.
+
+    Twins are patched the same way, except by the patches that look at the
+    filename, so builds touched by those are left out.
+    """
+    tar_index = repodata["packages"]
+    candidates = {}
+    for fn in repodata["packages.conda"]:
+        if not fn.endswith(".conda"):
+            continue
+        stem = fn[: -len(".conda")]
+        tar_fn = stem + ".tar.bz2"
+        if tar_fn not in tar_index:
+            continue
+        # only the .tar.bz2 filenames are looked up in OSX_SDK_FIXES
+        if subdir == "osx-64" and stem in OSX_SDK_FIXES:
+            continue
+        candidates[fn] = tar_fn
+
+    by_filename = filenames_matched_by_artifact_rules(
+        itertools.chain(candidates, candidates.values()), subdir
+    )
+    twins = {}
+    for fn, tar_fn in candidates.items():
+        if fn in by_filename or tar_fn in by_filename:
+            continue
+        if _metadata(repodata["packages.conda"][fn]) == _metadata(tar_index[tar_fn]):
+            twins[fn] = tar_fn
+    return twins
+
+
+def _copy_twin(tar_record, record):
+    """Set the metadata of record to that of its patched tar_record twin.
+
+    Only the fields that differ are set, so that an unchanged RecordOverlay
+    stays unchanged.
+    """
+    if isinstance(tar_record, RecordOverlay) and not tar_record.changed:
+        return record
+    for k, v in tar_record.items():
+        if k not in ARTIFACT_KEYS and (k not in record or record[k] != v):
+            record[k] = list(v) if isinstance(v, list) else v
+    for k in [k for k in record if k not in tar_record and k not in ARTIFACT_KEYS]:
+        del record[k]
+    return record
+
+
+def _patch_indexes(
+    repodata, subdir, verbose=False, explain=False, journal=None, matches=None
+):
+    """Patch the records of repodata in place.
+
+    If journal is a PatchJournal, the changes made by the Python patches
+    and by each patch yaml rule are added to it. If matches is a
+    defaultdict(set), the filenames of the records that the rules of each
+    patch yaml file matched are added to matches[fname].
+    """
+    # the .conda twins of .tar.bz2 records are patched through them
+    twins = _find_twins(repodata, subdir)
+    conda_index = repodata["packages.conda"]
+    repodata["packages.conda"] = {
+        fn: record for fn, record in conda_index.items() if fn not in twins
+    }
+    if verbose:
+        print(
+            f"Patching {len(twins)} .conda records through their .tar.bz2 twins",
+            file=sys.stderr,
+            flush=True,
+        )
+
     for index_key in ["packages", "packages.conda"]:
         index = repodata[index_key]
-        _gen_new_index_per_key(index, subdir, index_key=index_key, verbose=verbose)
-        patch_yaml_edit_index(index, subdir, verbose=verbose)
+        if journal is None:
+            _gen_new_index_per_key(index, subdir, index_key=index_key, verbose=verbose)
+        else:
+            _journal_python_patches(index, subdir, index_key, verbose, journal)
+        patch_yaml_edit_index(
+            index,
+            subdir,
+            verbose=verbose,
+            explain=explain,
+            journal=journal,
+            matches=matches,
+        )
+
+    # the other records were patched in place
+    repodata["packages.conda"] = conda_index
+    for fn, tar_fn in twins.items():
+        _copy_twin(repodata["packages"][tar_fn], conda_index[fn])
+    if journal is not None:
+        journal.add_twins(twins)
+    if matches is not None:
+        for fns in matches.values():
+            fns.update(fn for fn, tar_fn in twins.items() if tar_fn in fns)
+
+
+def _journal_python_patches(index, subdir, index_key, verbose, journal):
+    """Run the Python patches on index and add their changes to journal.
+
+    Records that are not RecordOverlay objects are patched through
+    overlays of them, which keep their values from before the patches.
+    """
+    overlays = index
+    if not all(isinstance(record, RecordOverlay) for record in index.values()):
+        overlays = {fn: RecordOverlay.from_record(r) for fn, r in index.items()}
+    python_journal = _PythonPatchJournal(journal, overlays)
+    _gen_new_index_per_key(
+        overlays,
+        subdir,
+        index_key=index_key,
+        verbose=verbose,
+        python_journal=python_journal,
+    )
+    python_journal.flush_all(overlays, "_gen_new_index_per_key")
+    if overlays is not index:
+        for fn, overlay in overlays.items():
+            index[fn].update(overlay.changes())
+
+
+class _TrackedList(list):
+    """A list in a RecordOverlay that records its key as written in the
+    overlay when it is changed in place."""
+
+    # the set of written keys shared with the overlay, rather than the
+    # overlay itself, so that the copies make no reference cycles
+    __slots__ = ("_written", "_key")
+
+
+def _tracked_list_method(name):
+    method = getattr(list, name)
+
+    def _changing(self, *args, **kwargs):
+        self._written.add(self._key)
+        return method(self, *args, **kwargs)
+
+    _changing.__name__ = name
+    return _changing
+
+
+for _name in [
+    "__setitem__",
+    "__delitem__",
+    "__iadd__",
+    "__imul__",
+    "append",
+    "extend",
+    "insert",
+    "pop",
+    "remove",
+    "clear",
+    "sort",
+    "reverse",
+]:
+    setattr(_TrackedList, _name, _tracked_list_method(_name))
+del _name
+
+
+class RecordOverlay(dict):
+    """A copy of a repodata record to patch, which keeps a reference to the
+    original record and records the keys that were written.
+
+    Make them with `RecordOverlay.from_record`. The lists and dicts of the
+    record are copied, so that patching them in place leaves the original
+    alone, while the strings and numbers in it are shared. Changing the
+    lists in place records their keys too. `changes` then gives the patch
+    instructions for the record from the written keys only, without
+    comparing anything if none were written.
+    """
+
+    __slots__ = ("base", "_written")
+
+    @classmethod
+    def from_record(cls, record):
+        # no __init__, which is noticeably slower over a whole repodata
+        self = cls(record)
+        self.base = record
+        self._written = written = set()
+        for k, v in record.items():
+            if type(v) is list:
+                v = _TrackedList(v)
+                v._written = written
+                v._key = k
+                dict.__setitem__(self, k, v)
+            elif type(v) is dict:
+                # not tracked, so the key counts as written
+                written.add(k)
+                dict.__setitem__(self, k, copy.deepcopy(v))
+        return self
+
+    @property
+    def changed(self):
+        """False if nothing was set on the record or changed in its lists."""
+        return bool(self._written)
+
+    def __setitem__(self, k, v):
+        # patches often set a key back to the same value, but a new list or
+        # dict that is equal to the old one may still be changed in place
+        # later, which is not tracked
+        if k not in self:
+            self._written.add(k)
+        else:
+            old = dict.__getitem__(self, k)
+            if old is not v and (isinstance(v, (list, dict)) or old != v):
+                self._written.add(k)
+        dict.__setitem__(self, k, v)
+
+    def __delitem__(self, k):
+        self._written.add(k)
+        dict.__delitem__(self, k)
+
+    def setdefault(self, k, default=None):
+        if k not in self:
+            self._written.add(k)
+        return dict.setdefault(self, k, default)
+
+    def pop(self, k, *args):
+        if k in self:
+            self._written.add(k)
+        return dict.pop(self, k, *args)
+
+    def update(self, *args, **kwargs):
+        other = dict(*args, **kwargs)
+        self._written.update(other)
+        dict.update(self, other)
+
+    def popitem(self):
+        k, v = dict.popitem(self)
+        self._written.add(k)
+        return k, v
+
+    def clear(self):
+        self._written.update(self)
+        dict.clear(self)
+
+    def changes(self):
+        """Return the written keys whose values differ from the original
+        record with their new values."""
+        changes = {}
+        for k in sorted(self._written):
+            assert k in self or k not in self.base, (k, self.base, self)
+            if k not in self:
+                continue
+            v = self[k]
+            if k not in self.base or self.base[k] != v:
+                changes[k] = _untracked(v)
+        return changes
+
+
+def _untracked(value):
+    return list(value) if type(value) is _TrackedList else value
+
+
+def _overlay_repodata(repodata):
+    """Return a copy of repodata whose records are RecordOverlay objects of
+    the records of repodata."""
+    new_repodata = dict(repodata)
+    # the copies make no reference cycles, but would trigger many collections
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for pkgs_section_key in ["packages", "packages.conda"]:
+            new_repodata[pkgs_section_key] = {
+                fn: RecordOverlay.from_record(record)
+                for fn, record in repodata.get(pkgs_section_key, {}).items()
+            }
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+    return new_repodata
 
 
 def _add_removals(instructions, subdir, package_removal_keeplist=None):
@@ -896,7 +1282,7 @@ def _add_removals(instructions, subdir, package_removal_keeplist=None):
     if r.status_code != 200:
         r.raise_for_status()
 
-    package_removal_keeplist = package_removal_keeplist or {}
+    package_removal_keeplist = set(package_removal_keeplist or ())
 
     data = r.json()
     currvals = list(REMOVALS.get(subdir, []))
@@ -929,8 +1315,13 @@ def _gen_patch_instructions(
     _add_removals(
         instructions, subdir, package_removal_keeplist=package_removal_keeplist
     )
+    _add_record_instructions(instructions, index, new_index, verbose=verbose)
+    return instructions
+
 
-    # diff all items in the index and put any differences in the instructions
+def _add_record_instructions(instructions, index, new_index, verbose=False):
+    """Diff all items in the index and put any differences in the
+    instructions."""
     for pkgs_section_key in ["packages", "packages.conda"]:
         if verbose:
             tqdm_progress = partial(
@@ -944,6 +1335,16 @@ def _gen_patch_instructions(
         for fn in tqdm_progress(index.get(pkgs_section_key, {})):
             assert fn in new_index[pkgs_section_key]
 
+            new_record = new_index[pkgs_section_key][fn]
+            if (
+                isinstance(new_record, RecordOverlay)
+                and new_record.base is index[pkgs_section_key][fn]
+            ):
+                changes = new_record.changes()
+                if changes:
+                    instructions[pkgs_section_key][fn] = changes
+                continue
+
             # replace any old keys
             for key in index[pkgs_section_key][fn]:
                 assert key in new_index[pkgs_section_key][fn], (
@@ -966,9 +1367,208 @@ def _gen_patch_instructions(
                         pkgs_section_key
                     ][fn][key]
 
+
+# the record fields that the Python patches and the patch yaml rules change
+PATCHED_FIELDS = frozenset(
+    ["constrains", "depends", "features", "license_family", "track_features"]
+)
+PATCH_MANIFEST_VERSION = 1
+# the code, other than the rules, that decides how records are patched
+PATCH_CODE_FILES = ["gen_patch_json.py", "get_license_family.py", "patch_yaml_utils.py"]
+
+
+def _code_fingerprint():
+    digest = hashlib.sha256()
+    recipe_dir = os.path.dirname(os.path.abspath(__file__))
+    for name in PATCH_CODE_FILES:
+        with open(join(recipe_dir, name), "rb") as fh:
+            digest.update(fh.read())
+    return digest.hexdigest()[:16]
+
+
+def _record_fingerprint(record):
+    data = json.dumps(record, sort_keys=True, separators=(",", ":"))
+    return hashlib.blake2b(data.encode("utf-8"), digest_size=8).hexdigest()
+
+
+def _make_patch_manifest(repodata, subdir):
+    """Return the fingerprints of the code, the rules and the records that
+    the patch instructions for repodata are made from."""
+    return {
+        "patch_manifest_version": PATCH_MANIFEST_VERSION,
+        "subdir": subdir,
+        "code": _code_fingerprint(),
+        "rules": [
+            {
+                "fingerprint": rule_fingerprint(compiled.patch_yaml),
+                "if": compiled.patch_yaml["if"],
+            }
+            for compiled in DEFAULT_RULE_SET.compiled_for_subdir(subdir)
+        ],
+        "records": {
+            pkgs_section_key: {
+                fn: _record_fingerprint(record)
+                for fn, record in repodata.get(pkgs_section_key, {}).items()
+            }
+            for pkgs_section_key in ["packages", "packages.conda"]
+        },
+    }
+
+
+def _changed_rule_ifs(old_rules, new_rules):
+    """Return the 'if' blocks of the rules of the two manifests that are
+    not common to both of them in the same order."""
+    matcher = difflib.SequenceMatcher(
+        None,
+        [rule["fingerprint"] for rule in old_rules],
+        [rule["fingerprint"] for rule in new_rules],
+        autojunk=False,
+    )
+    changed = []
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag != "equal":
+            changed.extend(rule["if"] for rule in old_rules[i1:i2])
+            changed.extend(rule["if"] for rule in new_rules[j1:j2])
+    return changed
+
+
+def _reuse_record_instructions(
+    repodata, subdir, manifest, old_manifest, old_instructions, verbose=False
+):
+    """Return the package sections of the patch instructions for repodata,
+    reusing those of a previous run, or None if they cannot be reused.
+
+    Only the records that are new or changed since the previous run, or
+    that a rule added, removed or edited since then may match, are
+    patched again. The others are patched the same as before, since the
+    patches do not change the fields that the conditions of the other
+    rules are tested on.
+    """
+    for key in ["patch_manifest_version", "subdir", "code"]:
+        if old_manifest.get(key) != manifest[key]:
+            if verbose:
+                print(
+                    f"Not reusing the patch instructions: the {key} changed",
+                    file=sys.stderr,
+                    flush=True,
+                )
+            return None
+
+    changed_ifs = _changed_rule_ifs(old_manifest["rules"], manifest["rules"])
+    stale = {}
+    for pkgs_section_key in ["packages", "packages.conda"]:
+        fingerprints = manifest["records"][pkgs_section_key]
+        old_fingerprints = old_manifest["records"].get(pkgs_section_key, {})
+        stale[pkgs_section_key] = {
+            fn
+            for fn, fingerprint in fingerprints.items()
+            if old_fingerprints.get(fn) != fingerprint
+        }
+        stale[pkgs_section_key].update(
+            filenames_possibly_matched(
+                repodata.get(pkgs_section_key, {}),
+                subdir,
+                changed_ifs,
+                PATCHED_FIELDS,
+            )
+        )
+    if verbose:
+        print(f"{len(changed_ifs)} rules changed", file=sys.stderr, flush=True)
+    return _repatch_records(repodata, subdir, stale, old_instructions, verbose=verbose)
+
+
+def _repatch_records(repodata, subdir, stale, old_instructions, verbose=False):
+    """Return the package sections of the patch instructions for repodata,
+    patching the records in stale, a set of filenames per section, again
+    and taking those of the others from old_instructions."""
+    stale_repodata = {}
+    instructions = {}
+    for pkgs_section_key in ["packages", "packages.conda"]:
+        index = repodata.get(pkgs_section_key, {})
+        stale_fns = stale[pkgs_section_key]
+        stale_repodata[pkgs_section_key] = {fn: index[fn] for fn in stale_fns}
+        instructions[pkgs_section_key] = defaultdict(
+            dict,
+            (
+                (fn, changes)
+                for fn, changes in old_instructions.get(pkgs_section_key, {}).items()
+                if fn in index and fn not in stale_fns
+            ),
+        )
+        if verbose:
+            print(
+                f"Patching {len(stale_fns)} of {len(index)} records of "
+                f"{pkgs_section_key} again",
+                file=sys.stderr,
+                flush=True,
+            )
+
+    new_stale_repodata = _overlay_repodata(stale_repodata)
+    _patch_indexes(new_stale_repodata, subdir, verbose=verbose)
+    _add_record_instructions(
+        instructions, stale_repodata, new_stale_repodata, verbose=verbose
+    )
     return instructions
 
 
+def _gen_patch_instructions_incremental(
+    repodata, subdir, previous_dir, manifest, verbose=False
+):
+    """Generate the patch instructions for repodata from those written by
+    a previous run to previous_dir/<subdir>, or return None if they are
+    missing or cannot be reused."""
+    try:
+        with open(join(previous_dir, subdir, "patch_manifest.json")) as fh:
+            old_manifest = json.load(fh)
+        with open(join(previous_dir, subdir, "patch_instructions.json")) as fh:
+            old_instructions = json.load(fh)
+    except FileNotFoundError as e:
+        if verbose:
+            print(
+                f"Not reusing the patch instructions: {e}", file=sys.stderr, flush=True
+            )
+        return None
+
+    record_instructions = _reuse_record_instructions(
+        repodata, subdir, manifest, old_manifest, old_instructions, verbose=verbose
+    )
+    if record_instructions is None:
+        return None
+    instructions = {
+        "patch_instructions_version": 1,
+        "revoke": [],
+        "remove": [],
+        **record_instructions,
+    }
+    _add_removals(instructions, subdir)
+    return instructions
+
+
+def _check_incremental_instructions(subdir, instructions, full_instructions):
+    """Raise if the instructions of an incremental run differ from those of
+    a full run."""
+    differing = []
+    for key in sorted(set(instructions) | set(full_instructions)):
+        value = instructions.get(key)
+        full_value = full_instructions.get(key)
+        if key in ["packages", "packages.conda"]:
+            value = value or {}
+            full_value = full_value or {}
+            differing.extend(
+                f"{key}/{fn}"
+                for fn in sorted(set(value) | set(full_value))
+                if value.get(fn) != full_value.get(fn)
+            )
+        elif value != full_value:
+            differing.append(key)
+    if differing:
+        raise RuntimeError(
+            f"The incremental patch instructions for {subdir} differ from a "
+            f"full run for {len(differing)} entries, starting with: "
+            + ", ".join(differing[:10])
+        )
+
+
 def _do_subdir(subdir, verbose=False):
     with tempfile.TemporaryDirectory() as tmpdir:
         raw_repodata_path = os.path.join(tmpdir, "repodata_from_packages.json.zst")
@@ -983,22 +1583,45 @@ def _do_subdir(subdir, verbose=False):
         with zstandard.open(ref_repodata_path) as fh:
             ref_repodata = json.load(fh)
 
-        # Copying large python dictionaries is slow, just reload the repodata
-        with zstandard.open(raw_repodata_path) as fh:
-            new_index = json.load(fh)
-
         prefix_dir = os.getenv("PREFIX", "tmp")
         prefix_subdir = join(prefix_dir, subdir)
         if not isdir(prefix_subdir):
             os.makedirs(prefix_subdir)
 
-        # Step 2a. Generate a new index -- in place operation
-        _patch_indexes(new_index, subdir, verbose=verbose)
+        journal = PatchJournal() if os.environ.get("CF_PATCH_JOURNAL") else None
+        previous_dir = os.environ.get("CF_INCREMENTAL_FROM")
+        manifest = None
+        # runs with CF_PKGS patch only some records, so they cannot be reused
+        if "CF_PKGS" not in os.environ and (
+            previous_dir or os.environ.get("CF_PATCH_MANIFEST")
+        ):
+            manifest = _make_patch_manifest(repodata, subdir)
+
+        # Step 2. Reuse the instructions of a previous run, patching only the
+        # records that may have changed. Not with a journal, which must list
+        # the changes to every record, or with CF_PKGS, which patches only
+        # some of them.
+        instructions = None
+        if previous_dir and journal is None and "CF_PKGS" not in os.environ:
+            instructions = _gen_patch_instructions_incremental(
+                repodata, subdir, previous_dir, manifest, verbose=verbose
+            )
 
-        # Step 2b. Generate the instructions by diff'ing the indices.
-        instructions = _gen_patch_instructions(
-            repodata, new_index, subdir, verbose=verbose
-        )
+        if instructions is None or os.environ.get("CF_INCREMENTAL_VERIFY"):
+            # patch copies of the records, which share their strings with the
+            # raw repodata, instead of parsing the repodata a second time
+            new_index = _overlay_repodata(repodata)
+
+            # Step 2a. Generate a new index -- in place operation
+            _patch_indexes(new_index, subdir, verbose=verbose, journal=journal)
+
+            # Step 2b. Generate the instructions by diff'ing the indices.
+            full_instructions = _gen_patch_instructions(
+                repodata, new_index, subdir, verbose=verbose
+            )
+            if instructions is not None:
+                _check_incremental_instructions(subdir, instructions, full_instructions)
+            instructions = full_instructions
 
         # Step 2c. Output this to $PREFIX so that we bundle the JSON files.
         patch_instructions_path = join(prefix_subdir, "patch_instructions.json")
@@ -1006,6 +1629,18 @@ def _do_subdir(subdir, verbose=False):
             json.dump(
                 instructions, fh, indent=2, sort_keys=True, separators=(",", ": ")
             )
+        if manifest is not None:
+            with open(join(prefix_subdir, "patch_manifest.json"), "w") as fh:
+                json.dump(manifest, fh, sort_keys=True, default=str)
+        if journal is not None:
+            with open(join(prefix_subdir, "patch_journal.json"), "w") as fh:
+                json.dump(
+                    journal.to_json(),
+                    fh,
+                    indent=2,
+                    sort_keys=True,
+                    separators=(",", ": "),
+                )
 
         # Step 3. Show the diff
         new_repodata = _apply_instructions(subdir, repodata, instructions)
@@ -1,12 +1,21 @@
+import bisect
 import fnmatch as _fnmatch
 import glob
+import hashlib
+import itertools
+import json
+import operator
 import os
+import pickle
 import re
 import string
 import sys
-from functools import lru_cache
+import tempfile
+from collections import defaultdict, namedtuple
+from functools import lru_cache, partial, total_ordering
 
 import yaml
+from packaging.version import InvalidVersion, Version
 from packaging.version import parse as parse_version
 
 ALLOWED_TEMPLATE_KEYS = [
@@ -21,23 +30,127 @@ ALLOWED_TEMPLATE_KEYS = [
     "patch_version",
 ]
 
-from patch_yaml_model import PatchYaml  # noqa
-
 OPERATORS = ["==", ">=", "<=", ">", "<", "!="]
 
-ALL_YAMLS = []
-for fname in sorted(glob.glob(os.path.dirname(__file__) + "/patch_yaml/*.yaml")):
-    with open(fname, "r") as fp:
-        fname_yamls = [
-            patch_yaml
-            for patch_yaml in yaml.safe_load_all(fp)
-            if patch_yaml is not None
-        ]
-        ALL_YAMLS += [(fy, os.path.basename(fname)) for fy in fname_yamls]
+# Parsed patch yaml documents are cached on disk, keyed by the sha256 of
+# each file, so that only new or changed files are parsed again. Set
+# CF_PATCH_YAML_CACHE to an empty string to disable the cache.
+PATCH_YAML_CACHE = os.environ.get(
+    "CF_PATCH_YAML_CACHE",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache", "patch_yaml.pkl"),
+)
+# bump whenever the layout of the cache changes
+_PATCH_YAML_CACHE_VERSION = 1
+
+
+def _parse_patch_yaml_file(data):
+    loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+    return [
+        patch_yaml
+        for patch_yaml in yaml.load_all(data, Loader=loader)
+        if patch_yaml is not None
+    ]
+
+
+def _read_patch_yaml_cache(cache_path):
+    try:
+        with open(cache_path, "rb") as fp:
+            cache = pickle.load(fp)
+    except Exception:
+        return {}
+    if not isinstance(cache, dict) or cache.get("version") != _PATCH_YAML_CACHE_VERSION:
+        return {}
+    return cache["files"]
+
+
+def _write_patch_yaml_cache(cache_path, files):
+    cache_dir = os.path.dirname(cache_path) or "."
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as fp:
+                pickle.dump(
+                    {"version": _PATCH_YAML_CACHE_VERSION, "files": files},
+                    fp,
+                    protocol=pickle.HIGHEST_PROTOCOL,
+                )
+            # atomic so that concurrent readers never see a partial file
+            os.replace(tmp_path, cache_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+    except OSError:
+        # the cache is only an optimization
+        pass
+
+
+def load_patch_yamls(patch_yaml_dir, cache_path=None):
+    """Load all patch yaml documents in a directory.
+
+    Returns a list of (patch_yaml, file basename) tuples sorted by file name.
+    If cache_path is given, parsed files are read from and stored in that
+    cache.
+    """
+    cached = _read_patch_yaml_cache(cache_path) if cache_path else {}
+    files = {}
+    patch_yamls = []
+    for fname in sorted(glob.glob(os.path.join(patch_yaml_dir, "*.yaml"))):
+        with open(fname, "rb") as fp:
+            data = fp.read()
+        key = hashlib.sha256(data).hexdigest()
+        if key in cached:
+            fname_yamls = cached[key]
+        else:
+            fname_yamls = _parse_patch_yaml_file(data)
+        files[key] = fname_yamls
+        patch_yamls += [(fy, os.path.basename(fname)) for fy in fname_yamls]
+
+    if cache_path and files.keys() != cached.keys():
+        _write_patch_yaml_cache(cache_path, files)
+    return patch_yamls
+
+
+PATCH_YAML_DIR = os.path.join(os.path.dirname(__file__), "patch_yaml")
+
+
+_GLOB_SPECIAL_CHARS_RE = re.compile(r"[*?\[]")
+
+
+def _is_literal_glob(pat):
+    return _GLOB_SPECIAL_CHARS_RE.search(pat) is None
 
 
 @lru_cache(maxsize=32768)
 def _fnmatch_build_re(pat):
+    """Build a match function for a pattern with the semantics of `fnmatch`.
+
+    The function returns None if the (case-normalized) string does not match
+    the pattern. Exact names, 'foo?( *)' and 'foo*' patterns are matched
+    with string operations. Only other globs are translated to a regex.
+    """
+    if _is_literal_glob(pat):
+        return {pat: True}.get
+
+    if pat.endswith("?( *)") and _is_literal_glob(pat[: -len("?( *)")]):
+        name = pat[: -len("?( *)")]
+        name_and_space = name + " "
+
+        def _match_name(item):
+            if item == name or item.startswith(name_and_space):
+                return True
+            return None
+
+        return _match_name
+
+    if pat.endswith("*") and _is_literal_glob(pat[:-1]):
+        prefix = pat[:-1]
+
+        def _match_prefix(item):
+            return True if item.startswith(prefix) else None
+
+        return _match_prefix
+
     repat = (
         "(?s:\\ .*)?".join([_fnmatch.translate(p)[:-2] for p in pat.split("?( *)")])
         + "\\Z"
@@ -45,7 +158,6 @@ def _fnmatch_build_re(pat):
     return re.compile(repat).match
 
 
-@lru_cache(maxsize=32768)
 def fnmatch(name, pat):
     """Test whether FILENAME matches PATTERN with custom
     allowed optional space via '?( *)'.
@@ -79,10 +191,106 @@ def fnmatch(name, pat):
     return match(name) is not None
 
 
-def _fnmatch_str_or_list(item, v):
-    if not isinstance(v, list):
-        v = [v]
-    return any(fnmatch(str(item), str(_v)) for _v in v)
+_CONDA_VERSION_SPLIT_RE = re.compile(r"([0-9]+|[*]+|[^0-9*]+)")
+
+
+def _conda_version_components(version):
+    """Split a version string the way conda's VersionOrder does."""
+    version = version.strip().lower()
+    if not version:
+        raise InvalidVersion("Empty version string")
+    epoch, _, version = version.rpartition("!")
+    version, _, local = version.partition("+")
+    if "-" in version and "_" not in version:
+        version = version.replace("-", "_")
+    version = version.replace("_", ".")
+
+    parts = []
+    for components in ([epoch or "0"] + version.split("."), local.split(".")):
+        parsed = []
+        for component in components:
+            if not component:
+                continue
+            split = []
+            for part in _CONDA_VERSION_SPLIT_RE.findall(component):
+                if part.isdigit():
+                    split.append(int(part))
+                elif part == "post":
+                    split.append(float("inf"))
+                elif part == "dev":
+                    # sorts before every other string
+                    split.append("DEV")
+                else:
+                    split.append(part)
+            if not component[0].isdigit():
+                split.insert(0, 0)
+            parsed.append(split)
+        parts.append(parsed)
+    return parts
+
+
+def _conda_version_cmp(v1, v2):
+    for t1, t2 in zip(v1, v2):
+        for c1, c2 in itertools.zip_longest(t1, t2, fillvalue=[0]):
+            for p1, p2 in itertools.zip_longest(c1, c2, fillvalue=0):
+                if p1 == p2:
+                    continue
+                # strings sort before numbers
+                if isinstance(p1, str) != isinstance(p2, str):
+                    return -1 if isinstance(p1, str) else 1
+                return -1 if p1 < p2 else 1
+    return 0
+
+
+@total_ordering
+class CondaVersion:
+    """A conda version that is not valid PEP 440, e.g. '1.0_1'.
+
+    It compares with other CondaVersion and with packaging Version objects
+    using conda's version ordering.
+    """
+
+    __slots__ = ("version", "_components")
+
+    def __init__(self, version):
+        self.version = version
+        self._components = _conda_version_components(version)
+
+    def _cmp(self, other):
+        if isinstance(other, CondaVersion):
+            return _conda_version_cmp(self._components, other._components)
+        if isinstance(other, Version):
+            return _conda_version_cmp(
+                self._components, _conda_version_components(str(other))
+            )
+        return NotImplemented
+
+    def __eq__(self, other):
+        c = self._cmp(other)
+        return c if c is NotImplemented else c == 0
+
+    def __lt__(self, other):
+        c = self._cmp(other)
+        return c if c is NotImplemented else c < 0
+
+    def __hash__(self):
+        return hash(self.version)
+
+    def __repr__(self):
+        return f"<CondaVersion('{self.version}')>"
+
+
+@lru_cache(maxsize=65536)
+def version_key(version):
+    """Memoized comparable key for a version string.
+
+    This is `packaging.version.parse` for PEP 440 versions and a
+    CondaVersion for any other conda version.
+    """
+    try:
+        return parse_version(version)
+    except InvalidVersion:
+        return CondaVersion(version)
 
 
 @lru_cache(maxsize=32768)
@@ -119,111 +327,274 @@ def _get_ver_comp(version, ind):
         return "0"
 
 
-def _maybe_process_template(value, record, subdir, old=None):
-    tvars = _get_vars_for_template(value, allow_old=old is not None)
-    if tvars:
-        data = {key: record[key] for key in tvars if key in record}
-        if "subdir" in tvars:
-            data["subdir"] = subdir
-        if "old" in tvars:
-            data["old"] = old
-        if "next_version" in tvars:
-            data["next_version"] = _get_next_version(record["version"])
-        if "major_version" in tvars:
-            data["major_version"] = _get_ver_comp(record["version"], 0)
-        if "minor_version" in tvars:
-            data["minor_version"] = _get_ver_comp(record["version"], 1)
-        if "patch_version" in tvars:
-            data["patch_version"] = _get_ver_comp(record["version"], 2)
-        return string.Template(value).substitute(**data)
-    else:
-        return value
+def _render_template(value, tvars, record, subdir, old=None):
+    data = {key: record[key] for key in tvars if key in record}
+    if "subdir" in tvars:
+        data["subdir"] = subdir
+    if "old" in tvars:
+        data["old"] = old
+    if "next_version" in tvars:
+        data["next_version"] = _get_next_version(record["version"])
+    if "major_version" in tvars:
+        data["major_version"] = _get_ver_comp(record["version"], 0)
+    if "minor_version" in tvars:
+        data["minor_version"] = _get_ver_comp(record["version"], 1)
+    if "patch_version" in tvars:
+        data["patch_version"] = _get_ver_comp(record["version"], 2)
+    return string.Template(value).substitute(**data)
+
+
+# record fields that templates read, directly or to compute the version parts
+_TEMPLATE_RECORD_KEYS = ["name", "version", "build_number", "build"]
+_VERSION_TEMPLATE_KEYS = [
+    "next_version",
+    "major_version",
+    "minor_version",
+    "patch_version",
+]
+_MISSING = object()
 
 
-def _test_patch_yaml(patch_yaml, record, subdir, fn):
-    keep = True
-    for k, v in patch_yaml["if"].items():
-        if k.startswith("not_"):
-            k = k[4:]
-            neg = True
-        else:
-            neg = False
+@lru_cache(maxsize=32768)
+def _compile_template(value, allow_old=False):
+    """Compile a template into a function of (record, subdir, old) that renders
+    it.
+
+    Renders are memoized on the values of the variables used by the
+    template, so e.g. a template using only ${version} is rendered once per
+    distinct version.
+    """
+    tvars = _get_vars_for_template(value, allow_old=allow_old)
+    if not tvars:
+        return lambda record, subdir, old=None: value
+
+    record_keys = [
+        key
+        for key in _TEMPLATE_RECORD_KEYS
+        if key in tvars
+        or (key == "version" and any(k in tvars for k in _VERSION_TEMPLATE_KEYS))
+    ]
+    uses_subdir = "subdir" in tvars
+    uses_old = "old" in tvars
+
+    @lru_cache(maxsize=4096)
+    def _render(values, subdir, old):
+        record = {k: v for k, v in zip(record_keys, values) if v is not _MISSING}
+        return _render_template(value, tvars, record, subdir, old=old)
+
+    def _renderer(record, subdir, old=None):
+        return _render(
+            tuple(record.get(key, _MISSING) for key in record_keys),
+            subdir if uses_subdir else None,
+            old if uses_old else None,
+        )
+
+    return _renderer
+
+
+_IF_OPS = {
+    "_lt": operator.lt,
+    "_le": operator.le,
+    "_gt": operator.gt,
+    "_ge": operator.ge,
+    "_eq": operator.eq,
+    "_ne": operator.ne,
+}
+_VERSION_GLOB_SYMBOLS = ["*", "[", "]", "?", "(", ")"]
+
+
+def _raise_when_called(e):
+    # errors in a rule are raised when the condition is evaluated, not when
+    # it is compiled, so that a broken rule only fails for records it reaches
+    def _raise(*args):
+        raise e
+
+    return _raise
+
+
+def _compile_fnmatch_str_or_list(v):
+    """Match function testing an item against a glob or a list of globs."""
+    if not isinstance(v, list):
+        v = [v]
+    matchers = [_fnmatch_build_re(os.path.normcase(str(_v))) for _v in v]
+
+    def _match(item):
+        item = os.path.normcase(str(item))
+        for match in matchers:
+            if match(item) is not None:
+                return True
+        return False
+
+    return _match
 
-        if k in record:
-            if k == "version" and not any(
-                symb in v for symb in ["*", "[", "]", "?", "(", ")"]
-            ):
-                _keep = parse_version(record[k]) == parse_version(v)
-            else:
-                _keep = fnmatch(str(record[k]), str(v))
 
-        elif k == "subdir_in":
-            _keep = _fnmatch_str_or_list(subdir, v)
+def _compile_record_key_test(k, v):
+    """Test for an 'if' key that is also a key of the record."""
+    try:
+        if k == "version" and not any(symb in v for symb in _VERSION_GLOB_SYMBOLS):
+            version = version_key(v)
+            return lambda value: version_key(value) == version
 
-        elif k[-3:] in ["_lt", "_le", "_gt", "_ge", "_eq", "_ne"] and (
-            k[:-3] in record
-            or k[:-3] in ["timestamp"]  # some records do not have a timestamp
-        ):
-            subk = k[:-3]
+        match = _compile_fnmatch_str_or_list(str(v))
+        return lambda value: match(value)
+    except Exception as e:
+        return _raise_when_called(e)
 
-            # some records do not have some keys, so we can
-            # special case that here
-            if subk == "timestamp":
-                rv = record.get(subk, 0)
+
+def _compile_op_test(subk, op, v):
+    """Test for '<key>_<op>' conditions, e.g. 'version_lt' or 'timestamp_le'."""
+    if subk == "version":
+        convert = version_key
+    elif subk in ["build_number", "timestamp"]:
+        convert = int
+    else:
+        convert = None
+
+    if convert is not None:
+        try:
+            v = convert(v)
+        except Exception as e:
+            return _raise_when_called(e)
+
+    if subk == "timestamp":
+        # some records do not have a timestamp
+        return lambda record: op(int(record.get(subk, 0)), v)
+    elif convert is not None:
+        return lambda record: op(convert(record[subk]), v)
+    else:
+        return lambda record: op(record[subk], v)
+
+
+def _compile_has_test(subk, v):
+    """Test for 'has_depends' and 'has_constrains' conditions."""
+    if not isinstance(v, list):
+        v = [v]
+    try:
+        matchers = [_fnmatch_build_re(os.path.normcase(_v)) for _v in v]
+    except Exception as e:
+        return _raise_when_called(e)
+
+    def _test(record):
+        for match in matchers:
+            for dep in record.get(subk, []):
+                if match(os.path.normcase(dep)) is not None:
+                    break
             else:
-                rv = record[subk]
-
-            if subk == "version":
-                rv = parse_version(rv)
-                v = parse_version(v)
-            elif subk in ["build_number", "timestamp"]:
-                rv = int(rv)
-                v = int(v)
-
-            op = k[-2:]
-            if op == "lt":
-                _keep = rv < v
-            elif op == "le":
-                _keep = rv <= v
-            elif op == "gt":
-                _keep = rv > v
-            elif op == "ge":
-                _keep = rv >= v
-            elif op == "eq":
-                _keep = rv == v
-            elif op == "ne":
-                _keep = rv != v
-
-        elif k.endswith("_in") and k[:-3] in record:
-            subk = k[:-3]
-            _keep = _fnmatch_str_or_list(record[subk], v)
-
-        elif k.startswith("has_") and k[len("has_") :] in ["depends", "constrains"]:
-            subk = k[len("has_") :]
-            if not isinstance(v, list):
-                v = [v]
-            _keep = all(
-                any(fnmatch(dep, _v) for dep in record.get(subk, [])) for _v in v
-            )
-        elif k == "has_track_features":
-            if not isinstance(v, list):
-                v = [v]
-            _keep = all(_has_track_feature(record, feature) for feature in v)
-        elif k == "artifact_in":
-            _keep = _fnmatch_str_or_list(fn, v)
+                return False
+        return True
+
+    return _test
+
+
+def _compile_if_condition(k, v):
+    """Compile a single 'if' condition into a function of (record, subdir, fn).
+
+    The checks that depend on the record (i.e., whether a key is present)
+    are still done at call time and in the same order as before, but all
+    of the key parsing, constant conversion and pattern compilation is
+    done once here.
+    """
+    if k.startswith("not_"):
+        k = k[4:]
+        neg = True
+    else:
+        neg = False
+
+    def _unrecognized(record, subdir, fn):
+        raise KeyError("Unrecognized 'if' key '%s'!" % k)
+
+    key_test = _compile_record_key_test(k, v)
+
+    if k == "subdir_in":
+        subdir_match = _compile_fnmatch_str_or_list(v)
+
+        def _other(record, subdir, fn):
+            return subdir_match(subdir)
+
+    elif k[-3:] in _IF_OPS:
+        subk = k[:-3]
+        op_test = _compile_op_test(subk, _IF_OPS[k[-3:]], v)
+
+        if subk == "timestamp":
+
+            def _other(record, subdir, fn):
+                return op_test(record)
 
         else:
-            raise KeyError("Unrecognized 'if' key '%s'!" % k)
 
-        if neg:
-            keep = keep and (not _keep)
+            def _other(record, subdir, fn):
+                if subk in record:
+                    return op_test(record)
+                return _unrecognized(record, subdir, fn)
+
+    elif k.endswith("_in"):
+        subk = k[:-3]
+        in_match = _compile_fnmatch_str_or_list(v)
+        if k == "artifact_in":
+
+            def _fallback(record, subdir, fn):
+                return in_match(fn)
+
         else:
-            keep = keep and _keep
+            _fallback = _unrecognized
 
-        if not keep:
-            break
+        def _other(record, subdir, fn):
+            if subk in record:
+                return in_match(record[subk])
+            return _fallback(record, subdir, fn)
+
+    elif k.startswith("has_") and k[len("has_") :] in ["depends", "constrains"]:
+        has_test = _compile_has_test(k[len("has_") :], v)
+
+        def _other(record, subdir, fn):
+            return has_test(record)
+
+    elif k == "has_track_features":
+        features = v if isinstance(v, list) else [v]
+
+        def _other(record, subdir, fn):
+            return all(_has_track_feature(record, feature) for feature in features)
+
+    else:
+        _other = _unrecognized
+
+    if neg:
+
+        def _test(record, subdir, fn):
+            if k in record:
+                return not key_test(record[k])
+            return not _other(record, subdir, fn)
 
-    return keep
+    else:
+
+        def _test(record, subdir, fn):
+            if k in record:
+                return key_test(record[k])
+            return _other(record, subdir, fn)
+
+    return _test
+
+
+def _compile_patch_yaml_if(patch_yaml_if):
+    """Compile the 'if' block of a patch yaml into a predicate of
+    (record, subdir, fn) that short-circuits like `_test_patch_yaml`."""
+    return _all_of([_compile_if_condition(k, v) for k, v in patch_yaml_if.items()])
+
+
+def _all_of(tests):
+    """Predicate that is true if all of tests are, testing them in order."""
+
+    def _test(record, subdir, fn):
+        for test in tests:
+            if not test(record, subdir, fn):
+                return False
+        return True
+
+    return _test
+
+
+def _test_patch_yaml(patch_yaml, record, subdir, fn):
+    return _compile_patch_yaml_if(patch_yaml["if"])(record, subdir, fn)
 
 
 def _has_track_feature(record, feature_name):
@@ -253,20 +624,23 @@ def _replace_pin(old_pin, new_pin, deps, record, target="depends"):
             record[target].pop(i)
 
 
-def _rename_dependency(fn, record, old_name, new_name, target="depends"):
-    if target not in ("depends", "constrains"):
-        raise ValueError(target)
-    if target not in record:
-        return
-    specs = record[target]
-    dep_idx = next(
-        (q for q, dep in enumerate(specs) if dep.split(" ")[0] == old_name), None
+DepSpec = namedtuple("DepSpec", ["name", "version", "build", "parts"])
+
+
+@lru_cache(maxsize=262144)
+def parse_dep_spec(dep):
+    """Split a spec like 'numpy >=1.21,<2.0a0 py39*' on spaces into a DepSpec.
+
+    Missing fields are None and parts holds every space separated part.
+    The results are cached since the same specs appear in many records.
+    """
+    parts = tuple(dep.split(" "))
+    return DepSpec(
+        parts[0],
+        parts[1] if len(parts) > 1 else None,
+        parts[2] if len(parts) > 2 else None,
+        parts,
     )
-    if dep_idx is not None:
-        parts = specs[dep_idx].split(" ")
-        remainder = (" " + " ".join(parts[1:])) if len(parts) > 1 else ""
-        specs[dep_idx] = new_name + remainder
-        record[target] = specs
 
 
 def pad_list(lst, num):
@@ -283,21 +657,31 @@ def get_upper_bound(version, max_pin):
     return ".".join(ver)
 
 
+# The per-spec transforms below are pure functions of their arguments. They
+# are memoized since the same specs show up in many records and subdirs.
+@lru_cache(maxsize=65536)
+def _relax_exact_dep(dep, max_pin=None):
+    """Relax an exact pin like 'foo 1.0.0 h1234_0' to 'foo >=1.0.0'."""
+    dep_parts = parse_dep_spec(dep).parts
+    if len(dep_parts) == 3 and not any(dep_parts[1].startswith(op) for op in OPERATORS):
+        if max_pin is not None:
+            upper_bound = get_upper_bound(dep_parts[1], max_pin) + "a0"
+            return "{} >={},<{}".format(*dep_parts[:2], upper_bound)
+        else:
+            return "{} >={}".format(*dep_parts[:2])
+    return dep
+
+
 def _relax_exact(fn, record, fix_dep, max_pin=None):
     depends = record.get("depends", ())
     dep_idx = next(
-        (q for q, dep in enumerate(depends) if dep.split(" ")[0] == fix_dep), None
+        (q for q, dep in enumerate(depends) if parse_dep_spec(dep).name == fix_dep),
+        None,
     )
     if dep_idx is not None:
-        dep_parts = depends[dep_idx].split(" ")
-        if len(dep_parts) == 3 and not any(
-            dep_parts[1].startswith(op) for op in OPERATORS
-        ):
-            if max_pin is not None:
-                upper_bound = get_upper_bound(dep_parts[1], max_pin) + "a0"
-                depends[dep_idx] = "{} >={},<{}".format(*dep_parts[:2], upper_bound)
-            else:
-                depends[dep_idx] = "{} >={}".format(*dep_parts[:2])
+        new_dep = _relax_exact_dep(depends[dep_idx], max_pin=max_pin)
+        if new_dep != depends[dep_idx]:
+            depends[dep_idx] = new_dep
             record["depends"] = depends
 
 
@@ -305,353 +689,1423 @@ CB_PIN_REGEX = re.compile(r"^>=(?P<lower>\d+(\.\d+)*a?),<(?P<upper>\d+(\.\d+)*)a
 CB_GT_REGEX = re.compile(r"^>=(?P<lower>\d+(\.\d+)*a?)[^<*]*$")
 
 
-def _pin_stricter(fn, record, fix_dep, max_pin, upper_bound=None):
-    depends = record.get("depends", ())
-    dep_indices = [q for q, dep in enumerate(depends) if dep.split(" ")[0] == fix_dep]
-    for dep_idx in dep_indices:
-        dep_parts = depends[dep_idx].split(" ")
-
-        if len(dep_parts) == 1 and upper_bound is not None:
-            upper_bound = upper_bound.split(".")
-            if str(upper_bound[-1]) != "0":
-                upper_bound += ["0"]
-            upper_bound = ".".join(upper_bound)
+@lru_cache(maxsize=65536)
+def _pin_stricter_dep(dep, max_pin, upper_bound=None):
+    """Return the dependency spec `dep` with a stricter upper bound, or `dep`
+    itself if it cannot or need not be tightened."""
+    dep_parts = parse_dep_spec(dep).parts
 
-            depends[dep_idx] = "{} <{}a0".format(
-                dep_parts[0],
-                upper_bound,
-            )
-            record["depends"] = depends
-            continue
+    if len(dep_parts) == 1 and upper_bound is not None:
+        upper_bound = upper_bound.split(".")
+        if str(upper_bound[-1]) != "0":
+            upper_bound += ["0"]
+        upper_bound = ".".join(upper_bound)
 
-        if len(dep_parts) not in [2, 3]:
-            continue
+        return "{} <{}a0".format(
+            dep_parts[0],
+            upper_bound,
+        )
 
-        m_gt = CB_GT_REGEX.match(dep_parts[1])
-        if m_gt is not None:
-            lower = m_gt.group("lower")
-            if upper_bound is None:
-                new_upper = get_upper_bound(lower, max_pin).split(".")
-            else:
-                new_upper = upper_bound.split(".")
-            _lower = lower.split(".")
-            _lower = pad_list(_lower, len(new_upper))
-            new_upper = pad_list(new_upper, len(_lower))
-
-            if parse_version(".".join(_lower)) < parse_version(".".join(new_upper)):
-                if str(new_upper[-1]) != "0":
-                    new_upper += ["0"]
-                new_upper = ".".join(new_upper)
-
-                if len(dep_parts) == 2:
-                    depends[dep_idx] = "{} {},<{}a0".format(
-                        dep_parts[0], dep_parts[1], new_upper
-                    )
-                elif len(dep_parts) == 3:
-                    depends[dep_idx] = "{} {},<{}a0 {}".format(
-                        dep_parts[0], dep_parts[1], new_upper, dep_parts[2]
-                    )
-                else:
-                    raise RuntimeError(f"Weird dep length in item '{depends[dep_idx]}'")
+    if len(dep_parts) not in [2, 3]:
+        return dep
 
-                record["depends"] = depends
+    m_gt = CB_GT_REGEX.match(dep_parts[1])
+    if m_gt is not None:
+        lower = m_gt.group("lower")
+        if upper_bound is None:
+            new_upper = get_upper_bound(lower, max_pin).split(".")
+        else:
+            new_upper = upper_bound.split(".")
+        _lower = lower.split(".")
+        _lower = pad_list(_lower, len(new_upper))
+        new_upper = pad_list(new_upper, len(_lower))
 
-            continue
+        if version_key(".".join(_lower)) < version_key(".".join(new_upper)):
+            if str(new_upper[-1]) != "0":
+                new_upper += ["0"]
+            new_upper = ".".join(new_upper)
 
-        m_pin = CB_PIN_REGEX.match(dep_parts[1])
-        if m_pin is not None:
-            lower = m_pin.group("lower")
-            upper = m_pin.group("upper").split(".")
-            if upper_bound is None:
-                new_upper = get_upper_bound(lower, max_pin).split(".")
-            else:
-                new_upper = upper_bound.split(".")
-            upper = pad_list(upper, len(new_upper))
-            new_upper = pad_list(new_upper, len(upper))
-            if parse_version(".".join(upper)) > parse_version(".".join(new_upper)):
-                if str(new_upper[-1]) != "0":
-                    new_upper += ["0"]
-                depends[dep_idx] = "{} >={},<{}a0".format(
-                    dep_parts[0], lower, ".".join(new_upper)
+            if len(dep_parts) == 2:
+                return "{} {},<{}a0".format(dep_parts[0], dep_parts[1], new_upper)
+            elif len(dep_parts) == 3:
+                return "{} {},<{}a0 {}".format(
+                    dep_parts[0], dep_parts[1], new_upper, dep_parts[2]
                 )
-                if len(dep_parts) == 3:
-                    depends[dep_idx] = "{} {}".format(depends[dep_idx], dep_parts[2])
-                record["depends"] = depends
-
-            continue
-
-        if (
-            len(dep_parts) == 2
-            and dep_parts[1].startswith("<")
-            and upper_bound is not None
-        ):
-            upper_bound = upper_bound.split(".")
-            if str(upper_bound[-1]) != "0":
-                upper_bound += ["0"]
-            upper_bound = ".".join(upper_bound)
-
-            old_upper = dep_parts[1].split("<")[1]
-            if old_upper.startswith("="):
-                # if the old pin is <=, we need to remove the =
-                # and we allow changes of eg <=15 to <15.0a0
-                # hence the condition includes >=
-                old_upper = old_upper[1:]
-                cond = parse_version(old_upper) >= parse_version(upper_bound)
             else:
-                cond = parse_version(old_upper) > parse_version(upper_bound)
-            if cond:
-                depends[dep_idx] = "{} <{}a0".format(
-                    dep_parts[0],
-                    upper_bound,
-                )
-                record["depends"] = depends
-            continue
-
+                raise RuntimeError(f"Weird dep length in item '{dep}'")
 
-def _pin_looser(fn, record, fix_dep, max_pin=None, upper_bound=None):
-    depends = record.get("depends", ())
-    dep_indices = [q for q, dep in enumerate(depends) if dep.split(" ")[0] == fix_dep]
-    for dep_idx in dep_indices:
-        dep_parts = depends[dep_idx].split(" ")
-        if len(dep_parts) not in [2, 3]:
-            continue
-        m = CB_PIN_REGEX.match(dep_parts[1])
-        if m is None:
-            continue
-        lower = m.group("lower")
-        upper = m.group("upper").split(".")
+        return dep
 
-        if (upper_bound is None or upper_bound == "None") and max_pin is None:
-            # case where we fully remove upper bound
-            depends[dep_idx] = f"{dep_parts[0]} >={lower}"
-            if len(dep_parts) == 3:
-                depends[dep_idx] = f"{depends[dep_idx]} {dep_parts[2]}"
-            record["depends"] = depends
-            continue
-        elif upper_bound is None:
+    m_pin = CB_PIN_REGEX.match(dep_parts[1])
+    if m_pin is not None:
+        lower = m_pin.group("lower")
+        upper = m_pin.group("upper").split(".")
+        if upper_bound is None:
             new_upper = get_upper_bound(lower, max_pin).split(".")
         else:
             new_upper = upper_bound.split(".")
-
         upper = pad_list(upper, len(new_upper))
         new_upper = pad_list(new_upper, len(upper))
-
-        if tuple(upper) < tuple(new_upper):
+        if version_key(".".join(upper)) > version_key(".".join(new_upper)):
             if str(new_upper[-1]) != "0":
                 new_upper += ["0"]
-            depends[dep_idx] = "{} >={},<{}a0".format(
-                dep_parts[0], lower, ".".join(new_upper)
-            )
+            new_dep = "{} >={},<{}a0".format(dep_parts[0], lower, ".".join(new_upper))
             if len(dep_parts) == 3:
-                depends[dep_idx] = "{} {}".format(depends[dep_idx], dep_parts[2])
-            record["depends"] = depends
+                new_dep = "{} {}".format(new_dep, dep_parts[2])
+            return new_dep
+
+        return dep
+
+    if len(dep_parts) == 2 and dep_parts[1].startswith("<") and upper_bound is not None:
+        upper_bound = upper_bound.split(".")
+        if str(upper_bound[-1]) != "0":
+            upper_bound += ["0"]
+        upper_bound = ".".join(upper_bound)
+
+        old_upper = dep_parts[1].split("<")[1]
+        if old_upper.startswith("="):
+            # if the old pin is <=, we need to remove the =
+            # and we allow changes of eg <=15 to <15.0a0
+            # hence the condition includes >=
+            old_upper = old_upper[1:]
+            cond = version_key(old_upper) >= version_key(upper_bound)
+        else:
+            cond = version_key(old_upper) > version_key(upper_bound)
+        if cond:
+            return "{} <{}a0".format(
+                dep_parts[0],
+                upper_bound,
+            )
 
+    return dep
+
+
+@lru_cache(maxsize=65536)
+def _pin_looser_dep(dep, max_pin=None, upper_bound=None):
+    """Return the dependency spec `dep` with a looser upper bound, or `dep`
+    itself if it cannot or need not be loosened."""
+    dep_parts = parse_dep_spec(dep).parts
+    if len(dep_parts) not in [2, 3]:
+        return dep
+    m = CB_PIN_REGEX.match(dep_parts[1])
+    if m is None:
+        return dep
+    lower = m.group("lower")
+    upper = m.group("upper").split(".")
+
+    if (upper_bound is None or upper_bound == "None") and max_pin is None:
+        # case where we fully remove upper bound
+        new_dep = f"{dep_parts[0]} >={lower}"
+        if len(dep_parts) == 3:
+            new_dep = f"{new_dep} {dep_parts[2]}"
+        return new_dep
+    elif upper_bound is None:
+        new_upper = get_upper_bound(lower, max_pin).split(".")
+    else:
+        new_upper = upper_bound.split(".")
 
-def _apply_patch_yaml(patch_yaml, record, subdir, fn):
-    for inst in patch_yaml["then"]:
-        for k, v in inst.items():
-            if k.startswith("add_") and k[len("add_") :] in ["depends", "constrains"]:
-                subk = k[len("add_") :]
-                if not isinstance(v, list):
-                    v = [v]
-                depends = record.get(subk, [])
-
-                v = [_maybe_process_template(_v, record, subdir) for _v in v]
-
-                for _v in v:
-                    if _v not in depends:
-                        depends.append(_v)
-
-                record[subk] = depends
-
-            elif k.startswith("remove_") and k[len("remove_") :] in [
-                "depends",
-                "constrains",
-            ]:
-                subk = k[len("remove_") :]
-                if not isinstance(v, list):
-                    v = [v]
-                depends = record.get(subk, [])
-
-                deps_to_remove = set()
-                for _v in v:
-                    for dep in depends:
-                        if fnmatch(dep, _v):
-                            deps_to_remove.add(dep)
-
-                for dep in deps_to_remove:
-                    depends.remove(dep)
+    upper = pad_list(upper, len(new_upper))
+    new_upper = pad_list(new_upper, len(upper))
 
-                if subk in record:
-                    record[subk] = depends
-
-            elif k.startswith("reset_") and k[len("reset_") :] in [
-                "depends",
-                "constrains",
-            ]:
-                subk = k[len("reset_") :]
-                if not isinstance(v, list):
-                    v = [v]
-
-                record[subk] = [_maybe_process_template(_v, record, subdir) for _v in v]
-
-            elif k == "remove_track_features":
-                if "track_features" in record and record["track_features"] is not None:
-                    if not isinstance(v, list):
-                        v = [v]
-                    for _v in v:
-                        record["track_features"] = _extract_track_feature(record, _v)
-                        if record["track_features"] is None:
-                            break
-
-            elif k == "add_track_features":
-                if not isinstance(v, list):
-                    v = [v]
-                for _v in v:
-                    record["track_features"] = _add_track_feature(record, _v)
-
-            elif k.startswith("replace_") and k[len("replace_") :] in [
-                "depends",
-                "constrains",
-            ]:
-                subk = k[len("replace_") :]
-                pat = _maybe_process_template(v["old"], record, subdir)
-                for dep in record.get(subk, []):
-                    if fnmatch(dep, pat):
-                        new_dep = _maybe_process_template(
-                            v["new"], record, subdir, old=dep
-                        )
-                        _replace_pin(
-                            dep,
-                            new_dep,
-                            record.get(subk, []),
-                            record,
-                            target=subk,
-                        )
-
-            elif k.startswith("rename_") and k[len("rename_") :] in [
-                "depends",
-                "constrains",
-            ]:
-                subk = k[len("rename_") :]
-                _rename_dependency(
-                    fn,
+    if tuple(upper) < tuple(new_upper):
+        if str(new_upper[-1]) != "0":
+            new_upper += ["0"]
+        new_dep = "{} >={},<{}a0".format(dep_parts[0], lower, ".".join(new_upper))
+        if len(dep_parts) == 3:
+            new_dep = "{} {}".format(new_dep, dep_parts[2])
+        return new_dep
+
+    return dep
+
+
+def _compile_dep_matchers(v):
+    if not isinstance(v, list):
+        v = [v]
+    return [_fnmatch_build_re(os.path.normcase(_v)) for _v in v]
+
+
+# Element-wise operations on a depends/constrains list. Each factory
+# returns a function of (record, subdir) that is called once per record and
+# returns a function mapping each spec of the list to its new value, or to
+# None if the spec is removed. Consecutive element-wise operations on the
+# same list are fused into a single pass over it.
+
+
+def _remove_deps_op(v):
+    matchers = _compile_dep_matchers(v)
+
+    def _bind(record, subdir):
+        removed = set()
+
+        def _op(dep):
+            ndep = os.path.normcase(dep)
+            if not any(match(ndep) is not None for match in matchers):
+                return dep
+            # only the first copy of a duplicated spec is removed
+            if dep in removed:
+                return dep
+            removed.add(dep)
+            return None
+
+        return _op
+
+    return _bind
+
+
+def _rename_deps_op(v):
+    old_template = _compile_template(v["old"])
+    new_template = _compile_template(v["new"])
+
+    def _bind(record, subdir):
+        old_name = old_template(record, subdir)
+        new_name = new_template(record, subdir)
+        # only the first spec with the old name is renamed
+        done = False
+
+        def _op(dep):
+            nonlocal done
+            if done:
+                return dep
+            parts = parse_dep_spec(dep).parts
+            if parts[0] != old_name:
+                return dep
+            done = True
+            remainder = (" " + " ".join(parts[1:])) if len(parts) > 1 else ""
+            return new_name + remainder
+
+        return _op
+
+    return _bind
+
+
+def _relax_exact_deps_op(v):
+    name_template = _compile_template(v["name"])
+    max_pin = v.get("max_pin", None)
+
+    def _bind(record, subdir):
+        fix_dep = name_template(record, subdir)
+        # only the first spec with the name is relaxed
+        done = False
+
+        def _op(dep):
+            nonlocal done
+            if done or parse_dep_spec(dep).name != fix_dep:
+                return dep
+            done = True
+            return _relax_exact_dep(dep, max_pin=max_pin)
+
+        return _op
+
+    return _bind
+
+
+def _pin_deps_op(v, pin_dep):
+    name_template = _compile_template(v["name"])
+    max_pin = v.get("max_pin", None)
+    upper_bound = v.get("upper_bound", None)
+    if upper_bound is not None:
+        upper_bound_template = _compile_template(str(upper_bound))
+
+    def _bind(record, subdir):
+        match = _fnmatch_build_re(os.path.normcase(name_template(record, subdir)))
+        if upper_bound is not None:
+            _upper_bound = upper_bound_template(record, subdir)
+        else:
+            _upper_bound = None
+
+        def _op(dep):
+            if match(os.path.normcase(parse_dep_spec(dep).name)) is None:
+                return dep
+            return pin_dep(dep, max_pin, upper_bound=_upper_bound)
+
+        return _op
+
+    return _bind
+
+
+def _run_deps_ops(binds, subk, record, subdir, fn):
+    ops = [_bind(record, subdir) for _bind in binds]
+    if subk not in record:
+        return
+    depends = record[subk]
+    new_depends = []
+    for dep in depends:
+        for op in ops:
+            dep = op(dep)
+            if dep is None:
+                break
+        else:
+            new_depends.append(dep)
+    if new_depends != depends:
+        depends[:] = new_depends
+        record[subk] = depends
+
+
+# Operations that need to see the whole list or field at once.
+
+
+def _add_deps_op(subk, v):
+    if not isinstance(v, list):
+        v = [v]
+    templates = [_compile_template(_v) for _v in v]
+
+    def _op(record, subdir, fn):
+        depends = record.get(subk, [])
+        for template in templates:
+            _v = template(record, subdir)
+            if _v not in depends:
+                depends.append(_v)
+        record[subk] = depends
+
+    return _op
+
+
+def _reset_deps_op(subk, v):
+    if not isinstance(v, list):
+        v = [v]
+    templates = [_compile_template(_v) for _v in v]
+
+    def _op(record, subdir, fn):
+        record[subk] = [template(record, subdir) for template in templates]
+
+    return _op
+
+
+def _replace_deps_op(subk, v):
+    old_template = _compile_template(v["old"])
+    new_template = _compile_template(v["new"], allow_old=True)
+
+    def _op(record, subdir, fn):
+        match = _fnmatch_build_re(os.path.normcase(old_template(record, subdir)))
+        for dep in record.get(subk, []):
+            if match(os.path.normcase(dep)) is not None:
+                new_dep = new_template(record, subdir, old=dep)
+                _replace_pin(
+                    dep,
+                    new_dep,
+                    record.get(subk, []),
                     record,
-                    _maybe_process_template(v["old"], record, subdir),
-                    _maybe_process_template(v["new"], record, subdir),
                     target=subk,
                 )
 
-            elif k == "relax_exact_depends":
-                fix_dep = _maybe_process_template(v["name"], record, subdir)
-                max_pin = v.get("max_pin", None)
-                _relax_exact(fn, record, fix_dep, max_pin=max_pin)
-
-            elif k == "tighten_depends":
-                pat = _maybe_process_template(v["name"], record, subdir)
-                max_pin = v.get("max_pin", None)
-                upper_bound = v.get("upper_bound", None)
-                if upper_bound is not None:
-                    upper_bound = _maybe_process_template(
-                        str(upper_bound), record, subdir
-                    )
-                for dep in record.get("depends", []):
-                    dep_name = dep.split(" ")[0]
-                    if fnmatch(dep_name, pat):
-                        _pin_stricter(
-                            fn,
-                            record,
-                            dep_name,
-                            max_pin,
-                            upper_bound=upper_bound,
-                        )
-
-            elif k == "loosen_depends":
-                pat = _maybe_process_template(v["name"], record, subdir)
-                max_pin = v.get("max_pin", None)
-                upper_bound = v.get("upper_bound", None)
-                if upper_bound is not None:
-                    upper_bound = _maybe_process_template(
-                        str(upper_bound), record, subdir
-                    )
-                for dep in record.get("depends", []):
-                    dep_name = dep.split(" ")[0]
-                    if fnmatch(dep_name, pat):
-                        _pin_looser(
-                            fn,
-                            record,
-                            dep_name,
-                            max_pin=max_pin,
-                            upper_bound=upper_bound,
-                        )
+    return _op
+
+
+def _remove_track_features_op(v):
+    if not isinstance(v, list):
+        v = [v]
+
+    def _op(record, subdir, fn):
+        if "track_features" in record and record["track_features"] is not None:
+            for _v in v:
+                record["track_features"] = _extract_track_feature(record, _v)
+                if record["track_features"] is None:
+                    break
+
+    return _op
+
+
+def _add_track_features_op(v):
+    if not isinstance(v, list):
+        v = [v]
+
+    def _op(record, subdir, fn):
+        for _v in v:
+            record["track_features"] = _add_track_feature(record, _v)
+
+    return _op
+
+
+def _unrecognized_then_op(k):
+    def _op(record, subdir, fn):
+        raise KeyError("Unrecognized 'then' key '%s'!" % k)
+
+    return _op
+
+
+def _compile_then_item(k, v):
+    """Compile a single 'then' instruction.
+
+    Returns (field, kind, op) where kind is "deps" for element-wise
+    operations on a depends/constrains list and "record" otherwise.
+    """
+    for prefix in ["add_", "remove_", "reset_", "replace_", "rename_"]:
+        if k.startswith(prefix) and k[len(prefix) :] in ["depends", "constrains"]:
+            subk = k[len(prefix) :]
+            break
+    else:
+        prefix = subk = None
+
+    if prefix == "add_":
+        return subk, "record", _add_deps_op(subk, v)
+    elif prefix == "remove_":
+        return subk, "deps", _remove_deps_op(v)
+    elif prefix == "reset_":
+        return subk, "record", _reset_deps_op(subk, v)
+    elif k == "remove_track_features":
+        return "track_features", "record", _remove_track_features_op(v)
+    elif k == "add_track_features":
+        return "track_features", "record", _add_track_features_op(v)
+    elif prefix == "replace_":
+        return subk, "record", _replace_deps_op(subk, v)
+    elif prefix == "rename_":
+        return subk, "deps", _rename_deps_op(v)
+    elif k == "relax_exact_depends":
+        return "depends", "deps", _relax_exact_deps_op(v)
+    elif k == "tighten_depends":
+        return "depends", "deps", _pin_deps_op(v, _pin_stricter_dep)
+    elif k == "loosen_depends":
+        return "depends", "deps", _pin_deps_op(v, _pin_looser_dep)
+    else:
+        return None, "record", _unrecognized_then_op(k)
+
 
+def _compile_patch_yaml_then(patch_yaml_then):
+    """Compile the 'then' block of a patch yaml into a function of
+    (record, subdir, fn) that applies it.
+
+    Instructions on different fields of a record are independent of each
+    other, so consecutive element-wise instructions on the same
+    depends/constrains list are run as a single pass over that list.
+    """
+    steps = []
+    open_passes = {}
+    for inst in patch_yaml_then:
+        for k, v in inst.items():
+            try:
+                field, kind, op = _compile_then_item(k, v)
+            except Exception as e:
+                field, kind, op = None, "record", _raise_when_called(e)
+            if field is None:
+                # nothing after an instruction that raises is applied
+                open_passes.clear()
+            if kind == "deps":
+                if field not in open_passes:
+                    open_passes[field] = []
+                    steps.append(partial(_run_deps_ops, open_passes[field], field))
+                open_passes[field].append(op)
             else:
-                raise KeyError("Unrecognized 'then' key '%s'!" % k)
+                open_passes.pop(field, None)
+                steps.append(op)
+
+    def _apply(record, subdir, fn):
+        for step in steps:
+            step(record, subdir, fn)
+
+    return _apply
+
+
+def _apply_patch_yaml(patch_yaml, record, subdir, fn):
+    _compile_patch_yaml_then(patch_yaml["then"])(record, subdir, fn)
 
 
 CONDA_PKG_NAME_RE = re.compile(r"^[a-z0-9_.-]+$")
 
 
-def shortlist_relevant_filenames(index, package_name_selector):
+def _build_name_index(index):
+    """Map each package name to the filenames of its records in the index."""
+    name_index = defaultdict(list)
+    for fn, record in index.items():
+        name_index[record["name"]].append(fn)
+    return name_index
+
+
+def _update_name_index(name_index, fn, old_name, new_name):
+    name_index[old_name].remove(fn)
+    if not name_index[old_name]:
+        del name_index[old_name]
+    name_index[new_name].append(fn)
+
+
+def _names_matching(name_index, package_name_selector):
+    """Resolve a (possibly globbed) name selector against the distinct
+    package names in a name index."""
+    package_name_selector = str(package_name_selector)
     if CONDA_PKG_NAME_RE.match(package_name_selector) is not None:
-        # package name does not contain wildcards
+        if package_name_selector in name_index:
+            return [package_name_selector]
+        return []
+    match = _fnmatch_build_re(os.path.normcase(package_name_selector))
+    return [name for name in name_index if match(os.path.normcase(name)) is not None]
+
+
+def _names_for_selectors(name_index, patch_yaml_if):
+    """Return the package names selected by the 'name' and 'name_in'
+    selectors of a patch yaml, or None if it has neither."""
+    names = None
+    if "name" in patch_yaml_if:
+        names = set(_names_matching(name_index, patch_yaml_if["name"]))
+    if "name_in" in patch_yaml_if:
+        v = patch_yaml_if["name_in"]
+        if not isinstance(v, list):
+            v = [v]
+        in_names = set()
+        for _v in v:
+            in_names.update(_names_matching(name_index, _v))
+        names = in_names if names is None else names & in_names
+    if names is None:
+        return None
+    return sorted(names)
+
+
+def _literal_artifacts(patch_yaml_if):
+    """Return the filenames of an 'artifact_in' condition without globs, or
+    None if it has globs or there is no such condition."""
+    if "artifact_in" not in patch_yaml_if or os.path.normcase("A") != "A":
+        return None
+    v = patch_yaml_if["artifact_in"]
+    if not isinstance(v, list):
+        v = [v]
+    v = [str(_v) for _v in v]
+    if not all(_is_literal_glob(_v) for _v in v):
+        return None
+    # deduplicated, in order
+    return list(dict.fromkeys(v))
+
+
+def _dep_name(dep):
+    return os.path.normcase(parse_dep_spec(dep).name)
+
+
+def _build_dep_index(index, subk):
+    """Map each package name in the 'depends' or 'constrains' of the records
+    to the filenames of the records that list it.
+
+    The values are dicts used as insertion ordered sets.
+    """
+    dep_index = defaultdict(dict)
+    for fn, record in index.items():
+        for dep in record.get(subk) or ():
+            dep_index[_dep_name(dep)][fn] = None
+    return dep_index
+
+
+@lru_cache(maxsize=None)
+def _dep_name_selector(pattern):
+    """Return (prefix, exact) describing the package names of the specs that
+    a 'has_depends' pattern can match.
+
+    If exact is True, only specs for the package named prefix can match.
+    Otherwise, the package name of any matching spec starts with prefix.
+    """
+    pattern = os.path.normcase(str(pattern))
+    prefix = re.match(r"[^*?\[ ]*", pattern).group()
+    rest = pattern[len(prefix) :]
+    return prefix, (rest == "" or rest == "?( *)" or rest.startswith(" "))
+
+
+class _RecordIndex:
+    """Secondary indexes over the records of a repodata index used to
+    shortlist the records that a patch yaml may apply to.
+
+    A shortlist is a superset of the records matching the 'if' block, which
+    is still tested for each of them. Indexes that are not fixed for the
+    whole run must be kept up to date with `record_changed`.
+    """
+
+    def __init__(self, index):
+        self.index = index
+        self.fns = sorted(index)
+        self.names = _build_name_index(index)
+        # built on first use
+        self._deps = {}
+        self._sorted_dep_names = {}
+        self._timestamps = None
+        self._versions = {}
+
+    def _dep_index(self, subk):
+        if subk not in self._deps:
+            self._deps[subk] = _build_dep_index(self.index, subk)
+            self._sorted_dep_names[subk] = sorted(self._deps[subk])
+        return self._deps[subk]
+
+    def _dep_names_matching(self, subk, pattern):
+        dep_index = self._dep_index(subk)
+        prefix, exact = _dep_name_selector(pattern)
+        if exact:
+            return [prefix] if prefix in dep_index else []
+        sorted_names = self._sorted_dep_names[subk]
+        names = []
+        for i in range(bisect.bisect_left(sorted_names, prefix), len(sorted_names)):
+            if not sorted_names[i].startswith(prefix):
+                break
+            names.append(sorted_names[i])
+        return names
+
+    def _artifact_candidates(self, patch_yaml_if):
+        fns = _literal_artifacts(patch_yaml_if)
+        if fns is not None:
+            fns = [fn for fn in fns if fn in self.index]
+            yield len(fns), "artifact_in", partial(list, fns)
+
+    def _has_candidates(self, patch_yaml_if):
+        for subk in ["depends", "constrains"]:
+            v = patch_yaml_if.get("has_" + subk)
+            if v is None:
+                continue
+            # every pattern must match, so any of them gives a shortlist
+            for pattern in v if isinstance(v, list) else [v]:
+                if _dep_name_selector(pattern)[0] == "":
+                    continue
+                dep_index = self._dep_index(subk)
+                names = self._dep_names_matching(subk, pattern)
+                yield (
+                    sum(len(dep_index[name]) for name in names),
+                    "has_" + subk,
+                    partial(_union_of_postings, dep_index, names),
+                )
+
+    def _timestamp_index(self):
+        """Return the record timestamps in ascending order and the filenames
+        in the same order, or None if some timestamp is not an integer."""
+        if self._timestamps is None:
+            try:
+                # records without a timestamp are tested as 0
+                timestamps = sorted(
+                    (int(record.get("timestamp", 0)), fn)
+                    for fn, record in self.index.items()
+                )
+            except (TypeError, ValueError):
+                self._timestamps = False
+            else:
+                self._timestamps = (
+                    [ts for ts, _ in timestamps],
+                    [fn for _, fn in timestamps],
+                )
+        return self._timestamps or None
+
+    def _timestamp_candidates(self, patch_yaml_if):
+        # patches never change timestamps, so this index is fixed
+        for k, side in [("timestamp_lt", "left"), ("timestamp_le", "right")]:
+            if k not in patch_yaml_if:
+                continue
+            try:
+                cutoff = int(patch_yaml_if[k])
+            except (TypeError, ValueError):
+                continue
+            timestamp_index = self._timestamp_index()
+            if timestamp_index is None:
+                return
+            timestamps, fns = timestamp_index
+            if side == "left":
+                end = bisect.bisect_left(timestamps, cutoff)
+            else:
+                end = bisect.bisect_right(timestamps, cutoff)
+            yield end, k, partial(operator.getitem, fns, slice(0, end))
+
+    def _version_index(self, name):
+        """Return the parsed versions of the records of a package in ascending
+        order and the filenames in the same order, or None if some version
+        cannot be parsed."""
+        if name not in self._versions:
+            try:
+                versions = sorted(
+                    (version_key(self.index[fn]["version"]), fn)
+                    for fn in self.names[name]
+                )
+                # conda and PEP 440 ordering do not mix into a total order
+                if not all(isinstance(ver, Version) for ver, _ in versions):
+                    raise TypeError(name)
+            except Exception:
+                self._versions[name] = None
+            else:
+                self._versions[name] = (
+                    [ver for ver, _ in versions],
+                    [fn for _, fn in versions],
+                )
+        return self._versions[name]
+
+    def _version_candidates(self, patch_yaml_if, names):
+        bounds = []
+        for k in ["version_lt", "version_le", "version_gt", "version_ge"]:
+            if k in patch_yaml_if:
+                try:
+                    ver = version_key(patch_yaml_if[k])
+                except Exception:
+                    continue
+                if isinstance(ver, Version):
+                    bounds.append((k[-2:], ver))
+        if not bounds:
+            return
+
+        slices = []
+        for name in names:
+            version_index = self._version_index(name)
+            if version_index is None:
+                slices.append((self.names[name], 0, len(self.names[name])))
+                continue
+            versions, fns = version_index
+            start, end = 0, len(versions)
+            for op, ver in bounds:
+                if op == "lt":
+                    end = min(end, bisect.bisect_left(versions, ver))
+                elif op == "le":
+                    end = min(end, bisect.bisect_right(versions, ver))
+                elif op == "gt":
+                    start = max(start, bisect.bisect_right(versions, ver))
+                else:
+                    start = max(start, bisect.bisect_left(versions, ver))
+            slices.append((fns, start, end))
+        yield (
+            sum(max(0, end - start) for _, start, end in slices),
+            "version",
+            partial(_concat_slices, slices),
+        )
+
+    def shortlist(self, patch_yaml_if):
+        """Return the filenames of the records to test against a patch yaml."""
+        return self.plan(patch_yaml_if).fns
+
+    def plan(self, patch_yaml_if, conditions=None):
+        """Plan how to find the records matching a patch yaml.
+
+        The index with the fewest candidates drives the plan. If the
+        compiled (key, test) conditions of the 'if' block are given, the
+        plan also orders them to test the cheapest and most selective first.
+        """
+        candidates = []
+        names = _names_for_selectors(self.names, patch_yaml_if)
+        if names is not None:
+            candidates.append(
+                (
+                    sum(len(self.names[name]) for name in names),
+                    "name",
+                    partial(_union_of_postings, self.names, names),
+                )
+            )
+            candidates.extend(self._version_candidates(patch_yaml_if, names))
+        candidates.extend(self._has_candidates(patch_yaml_if))
+        candidates.extend(self._timestamp_candidates(patch_yaml_if))
+        candidates.extend(self._artifact_candidates(patch_yaml_if))
+
+        counts = {}
+        for size, driver, _ in candidates:
+            counts[driver] = min(size, counts.get(driver, size))
+        if candidates:
+            _, driver, materialize = min(candidates, key=operator.itemgetter(0))
+            fns = materialize()
+        else:
+            driver, fns = "scan", self.fns
+
+        ordered = None
+        if conditions is not None:
+            ordered = _order_conditions(
+                conditions, patch_yaml_if, driver, counts, len(self.fns)
+            )
+        return _Plan(driver, counts, fns, ordered, conditions)
+
+    def record_changed(self, fn, record, old_name):
+        """Update the indexes after a patch yaml was applied to a record."""
+        if record["name"] != old_name:
+            _update_name_index(self.names, fn, old_name, record["name"])
+            self._versions.pop(old_name, None)
+            self._versions.pop(record["name"], None)
+        for subk, dep_index in self._deps.items():
+            for dep in record.get(subk) or ():
+                name = _dep_name(dep)
+                if name not in dep_index:
+                    bisect.insort(self._sorted_dep_names[subk], name)
+                dep_index[name][fn] = None
+
+
+class _Plan:
+    """The records to test against a patch yaml and the order in which to
+    test its conditions.
+
+    ``driver`` names the index the candidates come from ("scan" if none
+    applies) and ``counts`` maps each usable index to its candidate count.
+    """
+
+    __slots__ = ("driver", "counts", "fns", "conditions", "test")
+
+    def __init__(self, driver, counts, fns, conditions=None, original=None):
+        self.driver = driver
+        self.counts = counts
+        self.fns = fns
+        self.conditions = conditions
+        self.test = None
+        if conditions is not None:
+            self.test = _reordered_test(conditions, original or conditions)
+
+    def describe(self):
+        counts = ", ".join(f"{k}={v}" for k, v in sorted(self.counts.items()))
+        desc = f"{self.driver} ({len(self.fns)} candidates"
+        desc += f"; {counts})" if counts else ")"
+        if self.conditions is not None:
+            desc += " then " + ", ".join(k for k, _ in self.conditions)
+        return desc
+
+
+# conditions that the candidates of each index are (about) sure to pass
+_DRIVER_CONDITIONS = {
+    "name": ["name", "name_in"],
+    "version": [
+        "name",
+        "name_in",
+        "version_lt",
+        "version_le",
+        "version_gt",
+        "version_ge",
+    ],
+    "has_depends": ["has_depends"],
+    "has_constrains": ["has_constrains"],
+    "timestamp_lt": ["timestamp_lt"],
+    "timestamp_le": ["timestamp_le"],
+    "artifact_in": ["artifact_in"],
+}
+
+
+def _condition_cost(k, v):
+    """Rough relative cost of testing an 'if' condition against a record."""
+    if k.startswith("not_"):
+        k = k[4:]
+    n = len(v) if isinstance(v, list) else 1
+    if k in ["has_depends", "has_constrains"]:
+        # each pattern is matched against each dependency
+        return 4 * n
+    if k == "has_track_features" or k.startswith("version"):
+        return 2 * n
+    if k[-3:] in _IF_OPS:
+        return 1
+    return n
+
+
+def _order_conditions(conditions, patch_yaml_if, driver, counts, n_records):
+    """Order (key, test) conditions by cost over the chance of rejecting a
+    record, so that cheap conditions that reject most candidates come first.
+
+    The chance that a condition holds is estimated from the candidate
+    counts of its index, or taken as even if it has none. The conditions
+    that drove the candidates almost always hold and go last.
+    """
+    sure = set(_DRIVER_CONDITIONS.get(driver, ()))
+
+    def _rank(item):
+        k, _ = item
+        if k in sure:
+            return float("inf")
+        key = k[4:] if k.startswith("not_") else k
+        if key == "name_in":
+            key = "name"
+        p_true = counts[key] / n_records if key in counts and n_records else 0.5
+        if k.startswith("not_"):
+            p_true = 1.0 - p_true
+        if p_true >= 1.0:
+            return float("inf")
+        return _condition_cost(k, patch_yaml_if[k]) / (1.0 - p_true)
+
+    # sorted is stable, so ties keep the order of the 'if' block
+    return sorted(conditions, key=_rank)
+
+
+# conditions that do not look up keys that records may lack
+_NO_LOOKUP_CONDITIONS = {
+    "subdir_in",
+    "artifact_in",
+    "has_depends",
+    "has_constrains",
+    "has_track_features",
+}
+
+
+def _lookup_keys(k):
+    """Return the record keys of which one must be present for condition k
+    not to raise, or None if k does not need any."""
+    if k.startswith("not_"):
+        k = k[4:]
+    if k in _NO_LOOKUP_CONDITIONS:
+        return None
+    if k.endswith("_in") or k[-3:] in _IF_OPS:
+        if k[:-3] == "timestamp":
+            # records without a timestamp count as 0
+            return None
+        return (k, k[:-3])
+    return (k,)
+
+
+def _reordered_test(conditions, original):
+    """Predicate testing the (key, test) conditions in the given order that
+    gives the same result as testing them in their original order.
+
+    Conditions raise if a key they look up is missing, so a record that a
+    moved condition rejects, or for which a condition raises, and that lacks
+    one of these keys is tested again in the original order.
+    """
+    test = _all_of([test for _, test in conditions])
+    if [k for k, _ in conditions] == [k for k, _ in original]:
+        return test
+    original_test = _all_of([test for _, test in original])
+    lookups = [keys for keys in map(_lookup_keys, (k for k, _ in original)) if keys]
+
+    def _test(record, subdir, fn):
+        try:
+            if test(record, subdir, fn):
+                return True
+        except Exception:
+            return original_test(record, subdir, fn)
+        for keys in lookups:
+            if not any(key in record for key in keys):
+                return original_test(record, subdir, fn)
+        return False
+
+    return _test
+
+
+def _concat_slices(slices):
+    return [fn for fns, start, end in slices for fn in fns[start:end]]
+
+
+def _union_of_postings(postings, keys):
+    # a new list, so that the postings can change while it is iterated over
+    return list(dict.fromkeys(fn for key in keys for fn in postings[key]))
+
+
+class CompiledPatchYaml:
+    """A patch yaml document with its 'if' block compiled to a predicate and
+    its 'then' block compiled to a rewriter."""
+
+    __slots__ = (
+        "patch_yaml",
+        "fname",
+        "conditions",
+        "test",
+        "apply",
+        "_subdir_tests",
+        "_fields",
+    )
+
+    def __init__(self, patch_yaml, fname):
+        self.patch_yaml = patch_yaml
+        self.fname = fname
+        # (key, test) for each condition of the 'if' block, in order
+        self.conditions = [
+            (k, _compile_if_condition(k, v)) for k, v in patch_yaml["if"].items()
+        ]
+        self.test = _all_of([test for _, test in self.conditions])
+        self.apply = _compile_patch_yaml_then(patch_yaml["then"])
+        self._subdir_tests = _compile_subdir_tests(patch_yaml["if"])
+        self._fields = None
+
+    @property
+    def fields(self):
+        """The record fields that the 'then' block may change."""
+        if self._fields is None:
+            fields = []
+            for inst in self.patch_yaml["then"]:
+                for k, v in inst.items():
+                    field = _compile_then_item(k, v)[0]
+                    if field is not None and field not in fields:
+                        fields.append(field)
+            self._fields = fields
+        return self._fields
+
+    def may_apply_to_subdir(self, subdir):
+        """False if the 'subdir_in' or 'not_subdir_in' conditions exclude
+        every record of the subdir."""
+        return all(test(subdir) for test in self._subdir_tests)
+
+
+def _compile_subdir_tests(patch_yaml_if):
+    # these conditions only depend on the subdir being patched
+    tests = []
+    for k, neg in [("subdir_in", False), ("not_subdir_in", True)]:
+        if k not in patch_yaml_if:
+            continue
+        try:
+            match = _compile_fnmatch_str_or_list(patch_yaml_if[k])
+        except Exception:
+            # left for the 'if' test to report
+            continue
+        if neg:
+            tests.append(lambda subdir, match=match: not match(subdir))
+        else:
+            tests.append(match)
+    return tests
+
+
+class RuleSet:
+    """An ordered set of patch yaml rules.
+
+    Nothing is read or compiled until the rules are first used, so rule sets
+    are cheap to create. Use ``RuleSet.from_dir`` to load the yaml files in a
+    directory or ``RuleSet.from_patch_yamls`` for in-memory documents.
+    """
+
+    def __init__(self, loader):
+        self._loader = loader
+        self._patch_yamls = None
+        self._compiled = None
+        self._compiled_by_subdir = {}
+
+    @classmethod
+    def from_dir(cls, patch_yaml_dir, cache_path=None):
+        return cls(partial(load_patch_yamls, patch_yaml_dir, cache_path=cache_path))
+
+    @classmethod
+    def from_patch_yamls(cls, patch_yamls, fname="<memory>"):
+        """Make a rule set from a list of patch yaml documents.
+
+        Items may also be (patch_yaml, fname) tuples.
+        """
+        patch_yamls = [
+            item if isinstance(item, tuple) else (item, fname) for item in patch_yamls
+        ]
+        return cls(lambda: patch_yamls)
+
+    @property
+    def patch_yamls(self):
+        """List of (patch_yaml, fname) tuples."""
+        if self._patch_yamls is None:
+            self._patch_yamls = self._loader()
+        return self._patch_yamls
+
+    @property
+    def compiled(self):
+        """List of CompiledPatchYaml objects."""
+        if self._compiled is None:
+            self._compiled = [
+                CompiledPatchYaml(patch_yaml, fname)
+                for patch_yaml, fname in self.patch_yamls
+            ]
+        return self._compiled
+
+    def compiled_for_subdir(self, subdir):
+        """List of the CompiledPatchYaml objects that may apply to records
+        of a subdir."""
+        if subdir not in self._compiled_by_subdir:
+            self._compiled_by_subdir[subdir] = [
+                compiled
+                for compiled in self.compiled
+                if compiled.may_apply_to_subdir(subdir)
+            ]
+        return self._compiled_by_subdir[subdir]
+
+    def __iter__(self):
+        return iter(self.patch_yamls)
+
+    def __len__(self):
+        return len(self.patch_yamls)
+
+
+# the rules in patch_yaml/, loaded on first use
+DEFAULT_RULE_SET = RuleSet.from_dir(PATCH_YAML_DIR, cache_path=PATCH_YAML_CACHE or None)
+
+
+def __getattr__(name):
+    # ALL_YAMLS used to be filled at import time
+    if name == "ALL_YAMLS":
+        return DEFAULT_RULE_SET.patch_yamls
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def _report_patch_yaml_error(compiled):
+    import traceback
+
+    patch_yaml = compiled.patch_yaml
+    fname = compiled.fname
+    print(
+        "=" * 80
+        + "\n"
+        + "=" * 80
+        + "\nError in testing/applying patch yaml from '%s': \n\n%s"
+        % (fname, yaml.safe_dump(patch_yaml, default_flow_style=False)),
+        flush=True,
+    )
+    from patch_yaml_model import PatchYaml
+
+    try:
+        PatchYaml(**patch_yaml)
+    except Exception as se:
+        print(
+            f"Schema error in '{os.path.basename(fname)}': {se}",
+            flush=True,
+        )
+    print(
+        "=" * 80 + "\n" + "=" * 80,
+        flush=True,
+    )
+    traceback.print_exc()
+
+
+def _edit_index_rule_major(
+    index, subdir, rules, keep_pkgs, tqdm, explain=None, journal=None, matches=None
+):
+    """Apply each rule in turn to the records it may match.
+
+    If explain is a list, (compiled, plan, number of records matched) is
+    appended to it for each rule. If journal is a PatchJournal, the changes
+    made by each rule are added to it. If matches is a dict of sets, the
+    filenames of the records each rule matched are added to
+    matches[compiled.fname].
+    """
+    # built once per index and shared by every rule
+    record_index = _RecordIndex(index)
+    for compiled in tqdm(rules):
+        plan = record_index.plan(compiled.patch_yaml["if"], compiled.conditions)
+        n_matched = 0
+        for fn in plan.fns:
+            record = index[fn]
+            record_name = record["name"]
+            if keep_pkgs is not None and record_name not in keep_pkgs:
+                continue
+            try:
+                if plan.test(record, subdir, fn):
+                    if matches is not None:
+                        matches[compiled.fname].add(fn)
+                    if journal is None:
+                        compiled.apply(record, subdir, fn)
+                    else:
+                        journal.apply(compiled, record, subdir, fn)
+                    record_index.record_changed(fn, record, record_name)
+                    n_matched += 1
+            except Exception as e:
+                _report_patch_yaml_error(compiled)
+                raise e
+        if explain is not None:
+            explain.append((compiled, plan, n_matched))
+
+
+def _print_explain(subdir, explain, file=None):
+    """Print the plans of the rule-major engine, grouped by rule file."""
+    by_fname = defaultdict(list)
+    for compiled, plan, n_matched in explain:
+        by_fname[compiled.fname].append((plan, n_matched))
+    for fname, plans in by_fname.items():
+        print(f"{subdir}::{os.path.basename(fname)}: {len(plans)} rule(s)", file=file)
+        for i, (plan, n_matched) in enumerate(plans):
+            print(f"  {i}: {plan.describe()}; {n_matched} matched", file=file)
+
+
+class _RuleTable:
+    """Lookup of the rules that may apply to a record with a given name.
+
+    Rules with an 'artifact_in' condition without globs are keyed by
+    filename, rules with literal 'name' or 'name_in' selectors are keyed by
+    name, rules with globbed selectors are resolved once per package name
+    and all other rules apply to every name. Positions are in rule order.
+    """
+
+    def __init__(self, rules):
+        self._by_name = defaultdict(list)
+        self._by_artifact = defaultdict(list)
+        self._globbed = []
+        self._any_name = []
+        for pos, compiled in enumerate(rules):
+            patch_yaml_if = compiled.patch_yaml["if"]
+            artifacts = _literal_artifacts(patch_yaml_if)
+            if artifacts is not None:
+                for fn in artifacts:
+                    self._by_artifact[fn].append(pos)
+                continue
+            if "name" in patch_yaml_if:
+                selectors = [patch_yaml_if["name"]]
+            elif "name_in" in patch_yaml_if:
+                selectors = patch_yaml_if["name_in"]
+                if not isinstance(selectors, list):
+                    selectors = [selectors]
+            else:
+                self._any_name.append(pos)
+                continue
+            selectors = [str(selector) for selector in selectors]
+            if all(CONDA_PKG_NAME_RE.match(sel) is not None for sel in selectors):
+                for selector in selectors:
+                    self._by_name[selector].append(pos)
+            else:
+                self._globbed.append((pos, patch_yaml_if))
+        self._cache = {}
+
+    def positions(self, name):
+        """Return the sorted positions of the rules that may apply to name."""
+        if name not in self._cache:
+            positions = set(self._any_name)
+            positions.update(self._by_name.get(name, ()))
+            positions.update(
+                pos
+                for pos, patch_yaml_if in self._globbed
+                if _names_for_selectors({name: None}, patch_yaml_if)
+            )
+            self._cache[name] = sorted(positions)
+        return self._cache[name]
+
+    def positions_for_record(self, fn, name):
+        """Return the sorted positions of the rules that may apply to the
+        record fn with the given name."""
+        positions = self.positions(name)
+        if fn in self._by_artifact:
+            positions = sorted(set(positions).union(self._by_artifact[fn]))
+        return positions
+
+
+def _edit_index_record_major(
+    index, subdir, rules, keep_pkgs, tqdm, journal=None, matches=None
+):
+    """Apply the rules to each record in turn, in rule order.
+
+    If journal is a PatchJournal, the changes made by each rule are added
+    to it. If matches is a dict of sets, the filenames of the records each
+    rule matched are added to matches[compiled.fname].
+    """
+    rule_table = _RuleTable(rules)
+    for fn in tqdm(sorted(index)):
+        record = index[fn]
+        positions = rule_table.positions_for_record(fn, record["name"])
+        i = 0
+        while i < len(positions):
+            pos = positions[i]
+            i += 1
+            compiled = rules[pos]
+            record_name = record["name"]
+            if keep_pkgs is not None and record_name not in keep_pkgs:
+                continue
+            try:
+                if compiled.test(record, subdir, fn):
+                    if matches is not None:
+                        matches[compiled.fname].add(fn)
+                    if journal is None:
+                        compiled.apply(record, subdir, fn)
+                    else:
+                        journal.apply(compiled, record, subdir, fn)
+            except Exception as e:
+                _report_patch_yaml_error(compiled)
+                raise e
+            if record["name"] != record_name:
+                # continue with the later rules for the new name
+                positions = rule_table.positions_for_record(fn, record["name"])
+                i = bisect.bisect_right(positions, pos)
+
+
+def _copy_field(value):
+    return list(value) if isinstance(value, list) else value
+
+
+class PatchJournal:
+    """The changes made to records while patching them, with where they
+    come from.
+
+    ``entries`` lists (artifact, field, old value, new value, source) tuples
+    in the order the changes were made. The source of a patch yaml change is
+    the name of its rule file. A value of None stands for a missing field.
+    """
+
+    __slots__ = ("entries",)
+
+    def __init__(self):
+        self.entries = []
+
+    @staticmethod
+    def snapshot(record, fields=None):
+        """Return a copy of the values of fields (by default, all fields) of
+        record to pass to `add_changes` later."""
+        if fields is None:
+            fields = record
+        return {field: _copy_field(record.get(field, _MISSING)) for field in fields}
+
+    def add_changes(self, fn, before, record, source):
+        """Add the changes made to record since before, a snapshot of all of
+        its fields."""
+        self._add_field_changes(fn, before, record, source)
+        for field, new in record.items():
+            if field not in before:
+                self._add(fn, field, _MISSING, new, source)
+
+    def _add_field_changes(self, fn, before, record, source):
+        for field, old in before.items():
+            new = record.get(field, _MISSING)
+            if new != old:
+                self._add(fn, field, old, new, source)
+
+    def _add(self, fn, field, old, new, source):
+        self.entries.append(
+            (
+                fn,
+                field,
+                None if old is _MISSING else old,
+                None if new is _MISSING else _copy_field(new),
+                source,
+            )
+        )
+
+    def apply(self, compiled, record, subdir, fn):
+        """Apply a CompiledPatchYaml to record and add its changes."""
+        before = self.snapshot(record, compiled.fields)
+        compiled.apply(record, subdir, fn)
+        self._add_field_changes(fn, before, record, os.path.basename(compiled.fname))
+
+    def add_twins(self, twins):
+        """Repeat the changes of the artifacts that are values of twins for
+        the artifacts that are their keys."""
+        by_artifact = defaultdict(list)
+        for fn, twin_fn in twins.items():
+            by_artifact[twin_fn].append(fn)
+        self.entries.extend(
+            (fn,) + entry[1:]
+            for entry in list(self.entries)
+            for fn in by_artifact.get(entry[0], ())
+        )
+
+    def to_json(self):
         return [
-            fn
-            for fn, record in index.items()
-            if record["name"] == package_name_selector
+            {"artifact": fn, "field": field, "old": old, "new": new, "source": source}
+            for fn, field, old, new, source in self.entries
         ]
-    return index.keys()
 
 
-def patch_yaml_edit_index(index, subdir, verbose=False):
+def filenames_matched_by_artifact_rules(fns, subdir, rule_set=None):
+    """Return the filenames in fns that the 'artifact_in' or
+    'not_artifact_in' condition of a rule for subdir matches.
+
+    These are the only conditions that depend on the filename, so records
+    outside of this set are patched the same whatever their filename is.
+    """
+    if rule_set is None:
+        rule_set = DEFAULT_RULE_SET
+    fns = set(fns)
+    matched = set()
+    for compiled in rule_set.compiled_for_subdir(subdir):
+        patch_yaml_if = compiled.patch_yaml["if"]
+        for k in ["artifact_in", "not_artifact_in"]:
+            if k not in patch_yaml_if:
+                continue
+            literals = _literal_artifacts({"artifact_in": patch_yaml_if[k]})
+            if literals is not None:
+                matched.update(fns.intersection(literals))
+                continue
+            try:
+                match = _compile_fnmatch_str_or_list(patch_yaml_if[k])
+            except Exception:
+                # left for the 'if' test to report
+                return fns
+            matched.update(fn for fn in fns if match(fn))
+    return matched
+
+
+def rule_fingerprint(patch_yaml):
+    """Return a digest of a patch yaml document that is the same in every
+    run for the same document.
+
+    Keys are hashed in their order in the document, which is the order in
+    which conditions are tested and 'then' items read.
+    """
+    data = json.dumps(patch_yaml, separators=(",", ":"), default=str)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()[:16]
+
+
+def _condition_field(k):
+    # the record field that an 'if' condition tests
+    if k.startswith("not_"):
+        k = k[4:]
+    if k.startswith("has_"):
+        return k[4:]
+    if k.endswith("_in"):
+        return k[:-3]
+    if k[-3:] in _IF_OPS:
+        return k[:-3]
+    return k
+
+
+def filenames_possibly_matched(index, subdir, patch_yaml_ifs, patched_fields):
+    """Return the filenames of the records in index that one of the 'if'
+    blocks in patch_yaml_ifs may match at any point of patching.
+
+    Conditions on the fields in patched_fields, which patches may change,
+    are assumed to hold and the others are tested on the records as they
+    are. Records for which a condition raises are included.
+    """
+    record_index = None
+    matched = set()
+    for patch_yaml_if in patch_yaml_ifs:
+        patch_yaml_if = {
+            k: v
+            for k, v in patch_yaml_if.items()
+            if _condition_field(k) not in patched_fields
+        }
+        if not all(test(subdir) for test in _compile_subdir_tests(patch_yaml_if)):
+            continue
+        if record_index is None:
+            record_index = _RecordIndex(index)
+        test = _compile_patch_yaml_if(patch_yaml_if)
+        for fn in record_index.shortlist(patch_yaml_if):
+            if fn in matched:
+                continue
+            try:
+                if test(index[fn], subdir, fn):
+                    matched.add(fn)
+            except Exception:
+                matched.add(fn)
+    return matched
+
+
+# name -> function applying a rule set to an index
+PATCH_YAML_ENGINES = {
+    "rule": _edit_index_rule_major,
+    "record": _edit_index_record_major,
+}
+
+
+def patch_yaml_edit_index(
+    index,
+    subdir,
+    verbose=False,
+    rule_set=None,
+    engine=None,
+    explain=False,
+    journal=None,
+    matches=None,
+):
+    """Apply the patch yaml rules in rule_set (by default, those in
+    patch_yaml/) to the records of index in place.
+
+    engine selects how the rules are applied: "rule" visits the candidate
+    records of each rule in turn and "record" visits each record once,
+    applying its candidate rules in order. Both give the same result. The
+    default is taken from CF_PATCH_YAML_ENGINE or else is "rule".
+
+    If explain is true, the plan of each rule (the index its candidates come
+    from, the candidate counts and the order its conditions are tested in)
+    is printed to stderr. Only the "rule" engine makes plans, so it is used
+    whatever CF_PATCH_YAML_ENGINE is, unless another engine is passed.
+
+    If journal is a PatchJournal, the changes made by each rule are added
+    to it. If matches is a dict of sets, such as a defaultdict(set), the
+    filenames of the records that the rules of each rule file matched are
+    added to matches[fname].
+    """
+    if rule_set is None:
+        rule_set = DEFAULT_RULE_SET
+    if engine is None:
+        engine = "rule" if explain else os.environ.get("CF_PATCH_YAML_ENGINE", "rule")
+    if engine not in PATCH_YAML_ENGINES:
+        raise ValueError(
+            f"Unknown patch yaml engine '{engine}', "
+            f"expected one of {sorted(PATCH_YAML_ENGINES)}"
+        )
+    if explain and engine != "rule":
+        raise ValueError(f"The '{engine}' patch yaml engine has no plans to explain")
     keep_pkgs = os.environ.get("CF_PKGS", None)
     if keep_pkgs is not None:
         keep_pkgs = set(keep_pkgs.split(";"))
-    fns = sorted(index)
     if verbose:
         from tqdm import tqdm
-        from functools import partial
 
         tqdm = partial(tqdm, desc="Applying yaml patches", file=sys.stderr)
     else:
         tqdm = iter
-    for patch_yaml, fname in tqdm(ALL_YAMLS):
-        if "name" in patch_yaml["if"]:
-            pkg_name = patch_yaml["if"]["name"]
-            fns_to_process = shortlist_relevant_filenames(index, pkg_name)
-        else:
-            fns_to_process = fns
-
-        for fn in fns_to_process:
-            record = index[fn]
-            if keep_pkgs is not None and record["name"] not in keep_pkgs:
-                continue
-            try:
-                if _test_patch_yaml(patch_yaml, record, subdir, fn):
-                    _apply_patch_yaml(patch_yaml, record, subdir, fn)
-            except Exception as e:
-                import traceback
-
-                print(
-                    "=" * 80
-                    + "\n"
-                    + "=" * 80
-                    + "\nError in testing/applying patch yaml from '%s': \n\n%s"
-                    % (fname, yaml.safe_dump(patch_yaml, default_flow_style=False)),
-                    flush=True,
-                )
-                try:
-                    PatchYaml(**patch_yaml)
-                except Exception as se:
-                    print(
-                        f"Schema error in '{os.path.basename(fname)}': {se}",
-                        flush=True,
-                    )
-                print(
-                    "=" * 80 + "\n" + "=" * 80,
-                    flush=True,
-                )
-                traceback.print_exc()
-                raise e
-
+    rules = rule_set.compiled_for_subdir(subdir)
+    if explain:
+        plans = []
+        _edit_index_rule_major(
+            index,
+            subdir,
+            rules,
+            keep_pkgs,
+            tqdm,
+            explain=plans,
+            journal=journal,
+            matches=matches,
+        )
+        _print_explain(subdir, plans, file=sys.stderr)
+    else:
+        PATCH_YAML_ENGINES[engine](
+            index, subdir, rules, keep_pkgs, tqdm, journal=journal, matches=matches
+        )
     return index
@@ -1,10 +1,13 @@
 #!/usr/bin/env python
 
 import difflib
+import hashlib
 import json
 import os
+import subprocess
 import sys
 import urllib.request
+from collections import defaultdict
 from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import zstandard
@@ -14,6 +17,7 @@ CACHE_DIR = os.environ.get(
     "CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache")
 )
 BASE_URL = "https://conda.anaconda.org/conda-forge"
+IMPACT_MANIFEST_VERSION = 1
 
 
 def sort_lists(obj):
@@ -113,6 +117,152 @@ def _cut_index_to_name(repodata, name):
     return repodata
 
 
+def _file_fingerprint(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as fh:
+        for chunk in iter(lambda: fh.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()[:16]
+
+
+def _rule_fingerprints_by_file(subdir):
+    """Return the fingerprints of the rules for subdir of each patch yaml
+    file, by file name."""
+    from patch_yaml_utils import DEFAULT_RULE_SET, rule_fingerprint
+
+    fingerprints = defaultdict(list)
+    for compiled in DEFAULT_RULE_SET.compiled_for_subdir(subdir):
+        fingerprints[os.path.basename(compiled.fname)].append(
+            rule_fingerprint(compiled.patch_yaml)
+        )
+    return fingerprints
+
+
+def changed_patch_yamls_from_git():
+    """Return the names of the patch yaml files that are changed or new in
+    the git working tree, or None if git cannot tell."""
+    patch_yaml_dir = os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "patch_yaml"
+    )
+    names = set()
+    for cmd in [
+        ["git", "diff", "--name-only", "HEAD", "--", patch_yaml_dir],
+        ["git", "ls-files", "--others", "--exclude-standard", "--", patch_yaml_dir],
+    ]:
+        try:
+            out = subprocess.run(
+                cmd, cwd=patch_yaml_dir, capture_output=True, text=True, check=True
+            ).stdout
+        except (OSError, subprocess.CalledProcessError) as e:
+            print(
+                f"Could not list the changed patch yaml files with git ({e}), "
+                "patching all of the records",
+                file=sys.stderr,
+                flush=True,
+            )
+            return None
+        names.update(os.path.basename(path) for path in out.splitlines())
+    return sorted(names)
+
+
+def _write_impact_manifest(
+    impact_path, subdir, raw_repodata_path, matches, instructions
+):
+    """Write the artifacts that the rules of each patch yaml file matched in
+    a full run, with the package sections of its instructions."""
+    from gen_patch_json import _code_fingerprint
+
+    artifacts = defaultdict(set)
+    for fname, fns in matches.items():
+        artifacts[os.path.basename(fname)].update(fns)
+    rule_fingerprints = _rule_fingerprints_by_file(subdir)
+    impact = {
+        "impact_manifest_version": IMPACT_MANIFEST_VERSION,
+        "subdir": subdir,
+        "code": _code_fingerprint(),
+        "repodata": _file_fingerprint(raw_repodata_path),
+        "files": {
+            fname: {
+                "rules": rule_fingerprints[fname],
+                "artifacts": sorted(artifacts[fname]),
+            }
+            for fname in rule_fingerprints
+        },
+        "instructions": {
+            pkgs_section_key: instructions[pkgs_section_key]
+            for pkgs_section_key in ["packages", "packages.conda"]
+        },
+    }
+    with open(impact_path, "w") as fh:
+        json.dump(impact, fh, sort_keys=True)
+
+
+def _instructions_from_impact_manifest(
+    impact_path, subdir, raw_repodata, raw_repodata_path, changed_yamls, verbose=False
+):
+    """Return the package sections of the patch instructions for
+    raw_repodata, patching again only the records that the rules of the
+    changed patch yaml files matched in the last full run or may match now,
+    or None if the impact manifest is missing or out of date.
+
+    Files whose rules differ from those of the last full run are changed
+    too, whether or not they are in changed_yamls.
+    """
+    from gen_patch_json import PATCHED_FIELDS, _code_fingerprint, _repatch_records
+    from patch_yaml_utils import DEFAULT_RULE_SET, filenames_possibly_matched
+
+    def _skip(reason):
+        if verbose:
+            print(f"Patching all of {subdir}: {reason}", file=sys.stderr, flush=True)
+        return None
+
+    if not os.path.exists(impact_path):
+        return _skip("no impact manifest from a full run")
+    with open(impact_path) as fh:
+        impact = json.load(fh)
+    if impact.get("impact_manifest_version") != IMPACT_MANIFEST_VERSION:
+        return _skip("the impact manifest is from another version")
+    if impact["code"] != _code_fingerprint():
+        return _skip("the patching code changed since the last full run")
+    if impact["repodata"] != _file_fingerprint(raw_repodata_path):
+        return _skip("the repodata changed since the last full run")
+
+    rule_fingerprints = _rule_fingerprints_by_file(subdir)
+    old_files = impact["files"]
+    changed = {os.path.basename(fname) for fname in changed_yamls}
+    changed.update(
+        fname
+        for fname in set(rule_fingerprints) | set(old_files)
+        if rule_fingerprints.get(fname) != old_files.get(fname, {}).get("rules")
+    )
+    # the records the changed files matched before and may match now
+    stale_fns = set()
+    for fname in changed:
+        stale_fns.update(old_files.get(fname, {}).get("artifacts", ()))
+    changed_ifs = [
+        compiled.patch_yaml["if"]
+        for compiled in DEFAULT_RULE_SET.compiled_for_subdir(subdir)
+        if os.path.basename(compiled.fname) in changed
+    ]
+    stale = {}
+    for pkgs_section_key in ["packages", "packages.conda"]:
+        index = raw_repodata.get(pkgs_section_key, {})
+        stale[pkgs_section_key] = stale_fns.intersection(index)
+        stale[pkgs_section_key].update(
+            filenames_possibly_matched(index, subdir, changed_ifs, PATCHED_FIELDS)
+        )
+    if verbose:
+        print(
+            f"Patching the records of {subdir} that {len(changed)} changed "
+            "patch yaml file(s) may match",
+            file=sys.stderr,
+            flush=True,
+        )
+    return _repatch_records(
+        raw_repodata, subdir, stale, impact["instructions"], verbose=verbose
+    )
+
+
 def do_subdir(
     subdir,
     raw_repodata_path,
@@ -122,8 +272,25 @@ def do_subdir(
     package_removal_keeplist=None,
     verbose=False,
     debug_package_name=None,
+    explain=False,
+    changed_yamls=None,
 ):
-    from gen_patch_json import _patch_indexes, _gen_patch_instructions
+    """Return the diff of the repodata patched by the current rules against
+    the reference repodata.
+
+    A full run writes the artifacts that the rules of each patch yaml file
+    matched to an impact manifest next to the raw repodata. If
+    changed_yamls is a list of patch yaml files, only the records that the
+    rules of these files (and of any other file changed since) matched in
+    that run or may match now are patched again, and the rest are taken
+    from it.
+    """
+    from gen_patch_json import (
+        _add_removals,
+        _gen_patch_instructions,
+        _overlay_repodata,
+        _patch_indexes,
+    )
 
     if verbose:
         print(f"Decompressing raw repodata for {subdir}", file=sys.stderr, flush=True)
@@ -139,22 +306,53 @@ def do_subdir(
     if debug_package_name is not None:
         ref_repodata = _cut_index_to_name(ref_repodata, debug_package_name)
 
-    if verbose:
-        print(f"Decompressing new repodata for {subdir}", file=sys.stderr, flush=True)
-    # The repodata is so large, that copying a giant pyton dictionary
-    # is like way too slow, it is faster to read the repodata twice..
-    with zstandard.open(raw_repodata_path) as fh:
-        new_index = json.load(fh)
-    if debug_package_name is not None:
-        new_index = _cut_index_to_name(new_index, debug_package_name)
+    # only runs with all of the records are recorded or reused
+    impact_path = None
+    if debug_package_name is None and "CF_PKGS" not in os.environ:
+        impact_path = os.path.join(
+            os.path.dirname(raw_repodata_path), "patch_impact.json"
+        )
 
-    _patch_indexes(new_index, subdir, verbose=verbose)
-    instructions = _gen_patch_instructions(
-        raw_repodata,
-        new_index,
-        subdir,
-        package_removal_keeplist=package_removal_keeplist,
-    )
+    instructions = None
+    if impact_path is not None and changed_yamls is not None and not explain:
+        record_instructions = _instructions_from_impact_manifest(
+            impact_path,
+            subdir,
+            raw_repodata,
+            raw_repodata_path,
+            changed_yamls,
+            verbose=verbose,
+        )
+        if record_instructions is not None:
+            instructions = {
+                "patch_instructions_version": 1,
+                "revoke": [],
+                "remove": [],
+                **record_instructions,
+            }
+            _add_removals(
+                instructions, subdir, package_removal_keeplist=package_removal_keeplist
+            )
+
+    if instructions is None:
+        # patch copies of the records, which share their strings with the raw
+        # repodata, instead of parsing the repodata a second time
+        new_index = _overlay_repodata(raw_repodata)
+
+        matches = defaultdict(set)
+        _patch_indexes(
+            new_index, subdir, verbose=verbose, explain=explain, matches=matches
+        )
+        instructions = _gen_patch_instructions(
+            raw_repodata,
+            new_index,
+            subdir,
+            package_removal_keeplist=package_removal_keeplist,
+        )
+        if impact_path is not None:
+            _write_impact_manifest(
+                impact_path, subdir, raw_repodata_path, matches, instructions
+            )
     new_repodata = _apply_instructions(subdir, raw_repodata, instructions)
     return show_record_diffs(
         subdir, ref_repodata, new_repodata, fail_fast, group_diffs=group_diffs
@@ -176,6 +374,8 @@ def _process_subdir(
     package_removal_keeplist=None,
     verbose=False,
     debug_package_name=None,
+    explain=False,
+    changed_yamls=None,
 ):
     subdir_dir = os.path.join(CACHE_DIR, subdir)
     if not os.path.exists(subdir_dir):
@@ -195,6 +395,8 @@ def _process_subdir(
         package_removal_keeplist=package_removal_keeplist,
         verbose=verbose,
         debug_package_name=debug_package_name,
+        explain=explain,
+        changed_yamls=changed_yamls,
     )
     return subdir, vals
 
@@ -261,10 +463,34 @@ if __name__ == "__main__":
             "name to enable faster debugging."
         ),
     )
+    parser.add_argument(
+        "--explain",
+        action="store_true",
+        help=(
+            "Print to stderr how each patch yaml rule finds its records and "
+            "the candidate counts, grouped by rule file"
+        ),
+    )
+    parser.add_argument(
+        "--changed-yamls",
+        nargs="*",
+        default=None,
+        metavar="FILE",
+        help=(
+            "only patch again the records that the rules of these patch yaml "
+            "files matched in the last full run or may match now, taking the "
+            "others from that run; without files, those changed in git are "
+            "used"
+        ),
+    )
     args = parser.parse_args()
 
     from gen_patch_json import SUBDIRS
 
+    changed_yamls = args.changed_yamls
+    if changed_yamls == []:
+        changed_yamls = changed_patch_yamls_from_git()
+
     if args.subdirs is None:
         subdirs = SUBDIRS
     else:
@@ -285,6 +511,8 @@ if __name__ == "__main__":
             package_removal_keeplist=package_removal_keeplist,
             verbose=args.verbose,
             debug_package_name=args.debug_package_name,
+            explain=args.explain,
+            changed_yamls=changed_yamls,
         )
         _show_result(
             subdir,
@@ -303,6 +531,8 @@ if __name__ == "__main__":
                     group_diffs=not args.no_group_diffs,
                     package_removal_keeplist=package_removal_keeplist,
                     verbose=args.verbose,
+                    explain=args.explain,
+                    changed_yamls=changed_yamls,
                 )
                 for subdir in subdirs
             ]
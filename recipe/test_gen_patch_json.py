@@ -1,6 +1,21 @@
 import copy
 
-from gen_patch_json import REMOVALS, _gen_patch_instructions, add_python_abi
+import pytest
+
+from gen_patch_json import (
+    REMOVALS,
+    RecordOverlay,
+    _copy_twin,
+    _find_twins,
+    _add_record_instructions,
+    _gen_patch_instructions,
+    _make_patch_manifest,
+    _overlay_repodata,
+    _patch_indexes,
+    _reuse_record_instructions,
+    add_python_abi,
+)
+from patch_yaml_utils import PatchJournal
 
 
 def test_gen_patch_instructions():
@@ -126,3 +141,199 @@ def test_add_python_abi():
     }
     add_python_abi(exact_record, "osx-64")
     assert exact_record["constrains"] == []
+
+
+def test_find_twins():
+    record = {"name": "foo", "version": "1.0", "depends": ["python"]}
+
+    def _section(ext, fns):
+        return {
+            f"{fn}{ext}": dict(record, md5=f"{fn}{ext}", size=len(ext)) for fn in fns
+        }
+
+    stems = [
+        "foo-1.0-0",
+        "foo-1.0-1",
+        # named by an 'artifact_in' rule
+        "anaconda-cloud-cli-0.1.0-pyhd8ed1ab_0",
+        # looked up by its .tar.bz2 filename in OSX_SDK_FIXES
+        "nodejs-12.8.0-hec2bf70_1",
+    ]
+    repodata = {
+        "packages": _section(".tar.bz2", stems + ["foo-1.0-2"]),
+        "packages.conda": _section(".conda", stems + ["foo-1.0-3"]),
+    }
+    repodata["packages.conda"]["foo-1.0-1.conda"]["license"] = "MIT"
+
+    assert _find_twins(repodata, "osx-64") == {"foo-1.0-0.conda": "foo-1.0-0.tar.bz2"}
+    assert _find_twins(repodata, "linux-64") == {
+        "foo-1.0-0.conda": "foo-1.0-0.tar.bz2",
+        "nodejs-12.8.0-hec2bf70_1.conda": "nodejs-12.8.0-hec2bf70_1.tar.bz2",
+    }
+
+    tar_record = dict(repodata["packages"]["foo-1.0-0.tar.bz2"], depends=["x"])
+    conda_record = repodata["packages.conda"]["foo-1.0-0.conda"]
+    expected = dict(conda_record, depends=["x"])
+    assert _copy_twin(tar_record, conda_record) == expected
+    assert conda_record["depends"] is not tar_record["depends"]
+
+    # unchanged twins and fields are left alone
+    tar_record = repodata["packages"]["foo-1.0-2.tar.bz2"]
+    conda_record = RecordOverlay.from_record(dict(tar_record, md5="x"))
+    tar_record = RecordOverlay.from_record(tar_record)
+    _copy_twin(tar_record, conda_record)
+    assert not conda_record.changed
+    tar_record["license"] = "MIT"
+    _copy_twin(tar_record, conda_record)
+    assert conda_record.changes() == {"license": "MIT"}
+    tar_record.pop("license")
+    tar_record["depends"].append("x")
+    _copy_twin(tar_record, conda_record)
+    assert conda_record.changes() == {"depends": ["python", "x"]}
+
+
+def test_record_overlay():
+    record = {"name": "foo", "depends": ["a", "b"], "constrains": [], "size": 1}
+    overlay = RecordOverlay.from_record(record)
+    assert overlay == record
+    assert overlay.changes() == {}
+
+    # setting the same values does not flag the record
+    overlay["size"] = 1
+    overlay["constrains"] = overlay["constrains"]
+    overlay.setdefault("name", "bar")
+    overlay.pop("license", None)
+    assert not overlay.changed
+
+    for change in [
+        lambda depends: depends.append("c"),
+        lambda depends: depends.sort(reverse=True),
+        lambda depends: depends.__setitem__(0, "c"),
+    ]:
+        overlay = RecordOverlay.from_record(record)
+        change(overlay["depends"])
+        assert overlay.changed
+
+    # an equal but new list may be changed in place later
+    overlay = RecordOverlay.from_record(record)
+    overlay["constrains"] = list(overlay["constrains"])
+    overlay["constrains"].append("c")
+    assert overlay.changes() == {"constrains": ["c"]}
+
+    overlay = RecordOverlay.from_record(record)
+    overlay["depends"].append("c")
+    overlay["size"] = 1
+    overlay.setdefault("license", "MIT")
+    overlay["constrains"] = []
+    assert record == {"name": "foo", "depends": ["a", "b"], "constrains": [], "size": 1}
+    assert overlay.changes() == {"depends": ["a", "b", "c"], "license": "MIT"}
+    assert type(overlay.changes()["depends"]) is list
+
+    # only the written keys are compared
+    overlay = RecordOverlay.from_record(record)
+    overlay.update(size=2, name="foo")
+    overlay["depends"].remove("a")
+    overlay.pop("constrains")
+    assert overlay._written == {"constrains", "depends", "name", "size"}
+    with pytest.raises(AssertionError):
+        overlay.changes()
+    overlay["constrains"] = []
+    assert overlay.changes() == {"depends": ["b"], "size": 2}
+
+    index = {"packages": {"foo-1.0-0.tar.bz2": record}, "packages.conda": {}}
+    new_index = _overlay_repodata(index)
+    new_index["packages"]["foo-1.0-0.tar.bz2"]["name"] = "bar"
+    assert index["packages"]["foo-1.0-0.tar.bz2"]["name"] == "foo"
+    inst = _gen_patch_instructions(index, new_index, "osx-64")
+    assert inst["packages"] == {"foo-1.0-0.tar.bz2": {"name": "bar"}}
+    assert inst["packages.conda"] == {}
+
+
+def test_reuse_record_instructions():
+    def _record(name, version, depends):
+        return {
+            "name": name,
+            "version": version,
+            "build": "h1234_0",
+            "build_number": 0,
+            "depends": depends,
+            "license": "MIT",
+            "subdir": "linux-64",
+            "timestamp": 1600000000000,
+        }
+
+    def _full_instructions(repodata):
+        new_repodata = _overlay_repodata(repodata)
+        _patch_indexes(new_repodata, "linux-64")
+        instructions = {"packages": {}, "packages.conda": {}}
+        _add_record_instructions(instructions, repodata, new_repodata)
+        return instructions
+
+    repodata = {
+        "packages": {
+            "foo-1.0-h1234_0.tar.bz2": _record("foo", "1.0", ["libgcc-ng >=7"]),
+            "bar-1.0-h1234_0.tar.bz2": _record("bar", "1.0", ["python >=3.8"]),
+        },
+        "packages.conda": {
+            "foo-1.0-h1234_0.conda": _record("foo", "1.0", ["libgcc-ng >=7"]),
+        },
+    }
+    old_manifest = _make_patch_manifest(repodata, "linux-64")
+    old_instructions = {
+        "packages": {"foo-1.0-h1234_0.tar.bz2": {"depends": ["stale"]}},
+        "packages.conda": {"foo-1.0-h1234_0.conda": {"depends": ["stale"]}},
+    }
+    # a rule of the previous run for foo that has been removed since
+    old_manifest["rules"].insert(0, {"fingerprint": "removed", "if": {"name": "foo"}})
+
+    repodata["packages"]["bar-1.0-h1234_0.tar.bz2"]["depends"].append("zlib")
+    repodata["packages.conda"]["baz-1.0-h1234_0.conda"] = _record("baz", "1.0", [])
+    manifest = _make_patch_manifest(repodata, "linux-64")
+    instructions = _reuse_record_instructions(
+        repodata, "linux-64", manifest, old_manifest, old_instructions
+    )
+    assert instructions == _full_instructions(repodata)
+
+    old_manifest["code"] = "changed"
+    assert (
+        _reuse_record_instructions(
+            repodata, "linux-64", manifest, old_manifest, old_instructions
+        )
+        is None
+    )
+
+
+def test_patch_indexes_journal_sources():
+    fn = "foo-1.0-py38h1234_0.tar.bz2"
+    record = {
+        "name": "foo",
+        "version": "1.0",
+        "build": "py38h1234_0",
+        "build_number": 0,
+        "depends": ["python >=3.8,<3.9.0a0", "numpy =1.2"],
+        "subdir": "linux-64",
+        "timestamp": 1500000000000,
+    }
+    # the Python patches are journaled under the function that made them
+    expected = [
+        {
+            "artifact": fn,
+            "field": "constrains",
+            "old": None,
+            "new": ["python_abi * *_cp38"],
+            "source": "add_python_abi",
+        },
+        {
+            "artifact": fn,
+            "field": "depends",
+            "old": ["python >=3.8,<3.9.0a0", "numpy =1.2"],
+            "new": ["python >=3.8,<3.9.0a0", "numpy ==1.2.*"],
+            "source": "_gen_new_index_per_key",
+        },
+    ]
+    repodata = {"packages": {fn: record}, "packages.conda": {}}
+    for new_repodata in [_overlay_repodata(repodata), copy.deepcopy(repodata)]:
+        journal = PatchJournal()
+        _patch_indexes(new_repodata, "linux-64", journal=journal)
+        assert journal.to_json() == expected
+        assert new_repodata["packages"][fn]["constrains"] == ["python_abi * *_cp38"]
@@ -1,9 +1,37 @@
+import copy
+import os
+import pickle
+from collections import defaultdict
 from pathlib import Path
 
 import pytest
 import yaml
 from patch_yaml_model import PatchYaml, generate_schema
-from patch_yaml_utils import ALLOWED_TEMPLATE_KEYS, _apply_patch_yaml, _test_patch_yaml
+from patch_yaml_utils import (
+    ALLOWED_TEMPLATE_KEYS,
+    CONDA_PKG_NAME_RE,
+    DEFAULT_RULE_SET,
+    PatchJournal,
+    CompiledPatchYaml,
+    CondaVersion,
+    RuleSet,
+    _RecordIndex,
+    _apply_patch_yaml,
+    _compile_patch_yaml_if,
+    _compile_patch_yaml_then,
+    _compile_template,
+    _pin_looser_dep,
+    _pin_stricter_dep,
+    _test_patch_yaml,
+    _write_patch_yaml_cache,
+    filenames_possibly_matched,
+    fnmatch,
+    load_patch_yamls,
+    parse_dep_spec,
+    patch_yaml_edit_index,
+    rule_fingerprint,
+    version_key,
+)
 
 
 def test_test_patch_yaml_record_key():
@@ -194,6 +222,34 @@ def test_test_patch_yaml_has(sec):
     assert not _test_patch_yaml(patch_yaml, record, None, None)
 
 
+def test_compile_patch_yaml_if():
+    test = _compile_patch_yaml_if(
+        {
+            "name": "blah",
+            "version_lt": "2.0",
+            "not_has_depends": "numpy?( *)",
+            "timestamp_le": 10,
+        }
+    )
+    record = {"name": "blah", "version": "1.0", "depends": ["numpy-base"]}
+    assert test(record, None, None)
+    record["timestamp"] = 11
+    assert not test(record, None, None)
+    record["timestamp"] = 10
+    record["depends"].append("numpy 1.20")
+    assert not test(record, None, None)
+    record["depends"] = []
+    record["version"] = "2.0"
+    assert not test(record, None, None)
+
+    # unknown keys only raise once the condition is reached
+    test = _compile_patch_yaml_if({"name": "blah", "blarg_in": "foo"})
+    assert not test({"name": "foo"}, None, None)
+    with pytest.raises(KeyError):
+        test({"name": "blah"}, None, None)
+    assert test({"name": "blah", "blarg": "foo"}, None, None)
+
+
 @pytest.mark.parametrize("key", ["depends", "constrains"])
 def test_apply_patch_yaml_add(key):
     patch_yaml = {"then": [{"add_" + key: "blah"}]}
@@ -312,6 +368,64 @@ def test_apply_patch_yaml_remove(key):
     assert record == {"version": 10, key: ["foo"]}
 
 
+def test_compile_patch_yaml_then():
+    apply = _compile_patch_yaml_then(
+        [
+            {"remove_depends": ["blah", "foo*"]},
+            {"rename_depends": {"old": "bar", "new": "baz"}},
+            {"add_constrains": "qux"},
+            {"relax_exact_depends": {"name": "bar", "max_pin": "x"}},
+            {"tighten_depends": {"name": "baz", "max_pin": "x.x"}},
+        ]
+    )
+    record = {
+        "version": "1.0",
+        "depends": ["blah", "blah", "foo 1.0", "bar >=1.0", "bar 2.0.1 h_0", "foo"],
+    }
+    apply(record, None, None)
+    assert record == {
+        "version": "1.0",
+        "depends": ["blah", "baz >=1.0,<1.1.0a0", "bar >=2.0.1,<3.0.0a0"],
+        "constrains": ["qux"],
+    }
+
+    # element-wise instructions are skipped when the list is missing
+    record = {"version": "1.0"}
+    apply(record, None, None)
+    assert record == {"version": "1.0", "constrains": ["qux"]}
+
+    # add, reset and replace see the results of earlier instructions
+    apply = _compile_patch_yaml_then(
+        [
+            {"rename_depends": {"old": "bar", "new": "baz"}},
+            {"replace_depends": {"old": "baz*", "new": "${old} *_1"}},
+            {"remove_depends": "baz*"},
+        ]
+    )
+    record = {"version": "1.0", "depends": ["bar 1.0"]}
+    apply(record, None, None)
+    assert record == {"version": "1.0", "depends": []}
+
+    apply = _compile_patch_yaml_then([{"blarg_depends": "foo"}])
+    with pytest.raises(KeyError):
+        apply({"version": "1.0"}, None, None)
+
+    # malformed instructions only raise once they are applied
+    for inst, exc in [
+        ({"rename_depends": {"old": "foo"}}, KeyError),
+        ({"remove_depends": 1}, TypeError),
+        ({"tighten_depends": "foo"}, TypeError),
+    ]:
+        RuleSet.from_patch_yamls([{"if": {"name": "foo"}, "then": [inst]}])
+        apply = _compile_patch_yaml_then(
+            [{"remove_depends": "bar"}, inst, {"remove_depends": "baz"}]
+        )
+        record = {"depends": ["bar", "baz"]}
+        with pytest.raises(exc):
+            apply(record, None, None)
+        assert record == {"depends": ["baz"]}
+
+
 def test_apply_patch_yaml_remove_track_features():
     patch_yaml = {"then": [{"remove_track_features": "blah"}]}
     record = {"track_features": "blah"}
@@ -552,6 +666,65 @@ def test_apply_patch_yaml_loosen(pre, post):
     assert record == {"depends": pre + ["numpy >=1.0.0,<3.1.2.0a0"] + post}
 
 
+def test_record_index_shortlist_by_name():
+    index = {
+        "foo-1.0-0.tar.bz2": {"name": "foo"},
+        "foo-2.0-0.tar.bz2": {"name": "foo"},
+        "bar-1.0-0.tar.bz2": {"name": "bar"},
+    }
+    record_index = _RecordIndex(index)
+    for selector in ["foo", "bar", "baz"]:
+        assert sorted(record_index.shortlist({"name": selector})) == sorted(
+            fn for fn, record in index.items() if record["name"] == selector
+        )
+    assert sorted(record_index.shortlist({"name": "f*"})) == [
+        "foo-1.0-0.tar.bz2",
+        "foo-2.0-0.tar.bz2",
+    ]
+
+    index["bar-1.0-0.tar.bz2"]["name"] = "foo"
+    record_index.record_changed("bar-1.0-0.tar.bz2", index["bar-1.0-0.tar.bz2"], "bar")
+    assert "bar" not in record_index.names
+    assert record_index.shortlist({"name": "bar"}) == []
+    assert sorted(record_index.shortlist({"name": "foo"})) == [
+        "bar-1.0-0.tar.bz2",
+        "foo-1.0-0.tar.bz2",
+        "foo-2.0-0.tar.bz2",
+    ]
+
+
+def test_record_index_shortlist_by_name_globs():
+    index = {
+        "libfoo-1.0-0.tar.bz2": {"name": "libfoo"},
+        "libfoo-devel-1.0-0.tar.bz2": {"name": "libfoo-devel"},
+        "libbar-1.0-0.tar.bz2": {"name": "libbar"},
+        "baz-1.0-0.tar.bz2": {"name": "baz"},
+    }
+    record_index = _RecordIndex(index)
+
+    def _shortlist(patch_yaml_if):
+        return sorted(record_index.shortlist(patch_yaml_if))
+
+    assert _shortlist({"build": "h0"}) == sorted(index)
+    assert _shortlist({"name": "libfoo*"}) == [
+        "libfoo-1.0-0.tar.bz2",
+        "libfoo-devel-1.0-0.tar.bz2",
+    ]
+    assert _shortlist({"name": "lib???"}) == [
+        "libbar-1.0-0.tar.bz2",
+        "libfoo-1.0-0.tar.bz2",
+    ]
+    assert _shortlist({"name_in": ["baz", "libb*", "nope"]}) == [
+        "baz-1.0-0.tar.bz2",
+        "libbar-1.0-0.tar.bz2",
+    ]
+    assert _shortlist({"name_in": "baz"}) == ["baz-1.0-0.tar.bz2"]
+    assert _shortlist({"name": "lib*", "name_in": ["libfoo*", "baz"]}) == [
+        "libfoo-1.0-0.tar.bz2",
+        "libfoo-devel-1.0-0.tar.bz2",
+    ]
+
+
 def test_schema_up_to_date():
     schema_on_disk = (Path(__file__).parent / ("patch_yaml_model.json")).read_text()
     schema_str = generate_schema(write=False)
@@ -569,3 +742,698 @@ def test_schema_validation():
                 print(f"\nSchema error in {document.name}: {e}")
                 passed = False
     assert passed, "schema validation failed!"
+
+
+def test_load_patch_yamls_cache(tmp_path):
+    yaml_dir = tmp_path / "patch_yaml"
+    yaml_dir.mkdir()
+    (yaml_dir / "a.yaml").write_text(
+        "if:\n  name: foo\nthen:\n  - add_depends: bar\n---\n"
+        "if:\n  name: baz\nthen:\n  - add_depends: bar\n"
+    )
+    (yaml_dir / "b.yaml").write_text("if:\n  name: qux\nthen:\n  - add_depends: bar\n")
+    cache_path = tmp_path / "cache" / "patch_yaml.pkl"
+
+    expected = load_patch_yamls(yaml_dir)
+    assert [(py["if"]["name"], fname) for py, fname in expected] == [
+        ("foo", "a.yaml"),
+        ("baz", "a.yaml"),
+        ("qux", "b.yaml"),
+    ]
+    assert load_patch_yamls(yaml_dir, cache_path=cache_path) == expected
+    assert cache_path.exists()
+    assert load_patch_yamls(yaml_dir, cache_path=cache_path) == expected
+
+    # changed files are parsed again
+    (yaml_dir / "b.yaml").write_text("if:\n  name: quux\nthen:\n  - add_depends: bar\n")
+    assert load_patch_yamls(yaml_dir, cache_path=cache_path)[-1][0]["if"] == {
+        "name": "quux"
+    }
+
+    # a corrupt cache is ignored
+    cache_path.write_bytes(b"blah")
+    assert load_patch_yamls(yaml_dir, cache_path=cache_path) == load_patch_yamls(
+        yaml_dir
+    )
+
+
+def test_write_patch_yaml_cache_cleans_up(tmp_path, monkeypatch):
+    def _dump(obj, fp, protocol=None):
+        fp.write(b"partial")
+        raise pickle.PicklingError("blah")
+
+    monkeypatch.setattr(pickle, "dump", _dump)
+    cache_path = tmp_path / "patch_yaml.pkl"
+    with pytest.raises(pickle.PicklingError):
+        _write_patch_yaml_cache(str(cache_path), {})
+    assert list(tmp_path.iterdir()) == []
+
+    # failing to write the cache is not an error
+    def _replace(src, dst):
+        raise OSError("blah")
+
+    monkeypatch.setattr(os, "replace", _replace)
+    monkeypatch.setattr(pickle, "dump", lambda obj, fp, protocol=None: None)
+    _write_patch_yaml_cache(str(cache_path), {})
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_rule_set_from_patch_yamls():
+    calls = []
+
+    def _loader():
+        calls.append(1)
+        return [({"if": {"name": "foo"}, "then": [{"add_depends": "bar"}]}, "a.yaml")]
+
+    rule_set = RuleSet(_loader)
+    assert not calls
+    index = {"foo-1.0-0.conda": {"name": "foo", "depends": []}}
+    patch_yaml_edit_index(index, "linux-64", rule_set=rule_set)
+    assert index["foo-1.0-0.conda"]["depends"] == ["bar"]
+    patch_yaml_edit_index(index, "linux-64", rule_set=rule_set)
+    assert calls == [1]
+
+    rule_set = RuleSet.from_patch_yamls(
+        [
+            {"if": {"name": "foo"}, "then": [{"add_depends": "baz"}]},
+            ({"if": {"name": "baz"}, "then": [{"add_depends": "qux"}]}, "b.yaml"),
+        ]
+    )
+    assert [fname for _, fname in rule_set] == ["<memory>", "b.yaml"]
+    index = {
+        "foo-1.0-0.conda": {"name": "foo", "depends": []},
+        "baz-1.0-0.conda": {"name": "baz"},
+    }
+    patch_yaml_edit_index(index, "linux-64", rule_set=rule_set)
+    assert index == {
+        "foo-1.0-0.conda": {"name": "foo", "depends": ["baz"]},
+        "baz-1.0-0.conda": {"name": "baz", "depends": ["qux"]},
+    }
+
+
+def test_record_index_shortlist_has_depends():
+    index = {
+        "a.conda": {"name": "a", "depends": ["numpy >=1.20", "python"]},
+        "b.conda": {"name": "b", "depends": ["numpy-base"]},
+        "c.conda": {"name": "c", "depends": ["python"], "constrains": ["numpy"]},
+        "d.conda": {"name": "d"},
+    }
+    record_index = _RecordIndex(index)
+    assert record_index.shortlist({"version": "1.0"}) == sorted(index)
+    assert record_index.shortlist({"has_depends": "numpy?( *)"}) == ["a.conda"]
+    assert sorted(record_index.shortlist({"has_depends": "numpy*"})) == [
+        "a.conda",
+        "b.conda",
+    ]
+    assert record_index.shortlist({"has_constrains": "numpy"}) == ["c.conda"]
+    assert record_index.shortlist({"has_depends": ["python", "numpy"]}) == ["a.conda"]
+    assert record_index.shortlist({"name": "d", "has_depends": "python"}) == ["d.conda"]
+    # no literal name to look up
+    assert record_index.shortlist({"has_depends": "*numpy"}) == sorted(index)
+
+    # records are added when a patch adds the dependency
+    index["d.conda"]["depends"] = ["numpy-base 1.*"]
+    record_index.record_changed("d.conda", index["d.conda"], "d")
+    assert sorted(record_index.shortlist({"has_depends": "numpy*"})) == [
+        "a.conda",
+        "b.conda",
+        "d.conda",
+    ]
+
+
+def test_record_index_shortlist_timestamp():
+    index = {
+        "a.conda": {"name": "a", "timestamp": 30},
+        "b.conda": {"name": "b", "timestamp": 10},
+        "c.conda": {"name": "c"},
+        "d.conda": {"name": "d", "timestamp": 20},
+    }
+    record_index = _RecordIndex(index)
+    assert record_index.shortlist({"timestamp_lt": 20}) == ["c.conda", "b.conda"]
+    assert record_index.shortlist({"timestamp_le": 20}) == [
+        "c.conda",
+        "b.conda",
+        "d.conda",
+    ]
+    assert record_index.shortlist({"timestamp_lt": 0}) == []
+    assert record_index.shortlist({"name": "a", "timestamp_lt": 40}) == ["a.conda"]
+    assert record_index.shortlist({"timestamp_lt": 5, "timestamp_le": 40}) == [
+        "c.conda"
+    ]
+    # negated conditions do not shortlist
+    assert record_index.shortlist({"not_timestamp_lt": 20}) == sorted(index)
+
+
+def test_record_index_shortlist_version():
+    index = {
+        f"foo-{ver}-0.conda": {"name": "foo", "version": ver}
+        for ver in ["1.10.0", "1.2.0", "1.9.1", "2.0.0rc1", "2.0.0"]
+    }
+    index["bar-1.0-0.conda"] = {"name": "bar", "version": "1.0"}
+    index["baz-1.0-0.conda"] = {"name": "baz", "version": "not a version"}
+    record_index = _RecordIndex(index)
+    assert record_index.shortlist({"name": "foo", "version_lt": "1.10"}) == [
+        "foo-1.2.0-0.conda",
+        "foo-1.9.1-0.conda",
+    ]
+    assert record_index.shortlist({"name": "foo", "version_le": "1.10"}) == [
+        "foo-1.2.0-0.conda",
+        "foo-1.9.1-0.conda",
+        "foo-1.10.0-0.conda",
+    ]
+    assert record_index.shortlist(
+        {"name": "foo", "version_gt": "1.9.1", "version_lt": "2"}
+    ) == ["foo-1.10.0-0.conda", "foo-2.0.0rc1-0.conda"]
+    assert record_index.shortlist({"name": "foo", "version_ge": "2.0.0"}) == [
+        "foo-2.0.0-0.conda"
+    ]
+    assert record_index.shortlist(
+        {"name_in": ["bar", "foo"], "version_ge": "1.10"}
+    ) == ["foo-1.10.0-0.conda", "foo-2.0.0rc1-0.conda", "foo-2.0.0-0.conda"]
+    # unparsable versions are left to the 'if' test
+    assert record_index.shortlist({"name": "ba*", "version_lt": "2"}) == [
+        "bar-1.0-0.conda",
+        "baz-1.0-0.conda",
+    ]
+
+
+def test_version_key():
+    assert version_key("1.0.0") == version_key("1.0")
+    assert version_key("1.0rc1") < version_key("1.0") < version_key("1.0.post1")
+    assert version_key("1.2.3") is version_key("1.2.3")
+
+    # conda versions that are not PEP 440 use conda's ordering
+    assert isinstance(version_key("1.0_1"), CondaVersion)
+    assert version_key("1.0") < version_key("1.0_1") < version_key("1.0_2")
+    assert version_key("1.0_2") < version_key("1.1")
+    assert version_key("1.0_1") == CondaVersion("1.0.1")
+    assert version_key("1.1_1") > version_key("1.1dev_1")
+    assert version_key("1.1_1") > version_key("1.1a_1")
+
+    patch_yaml = {"if": {"version_lt": "1.1"}}
+    assert _test_patch_yaml(patch_yaml, {"version": "1.0_1"}, None, None)
+    assert not _test_patch_yaml(patch_yaml, {"version": "1.1_1"}, None, None)
+
+
+@pytest.mark.parametrize(
+    "pat,matches,non_matches",
+    [
+        ("numpy", ["numpy"], ["numpy ", "numpy 1.0", "numpy-base", "nump"]),
+        (
+            "numpy?( *)",
+            ["numpy", "numpy ", "numpy >=1.0"],
+            ["numpy-base", "numpy-base 1.0", "numpyx"],
+        ),
+        ("numpy*", ["numpy", "numpy >=1\n", "numpy-base"], ["nump", "xnumpy"]),
+        ("numpy 1.*", ["numpy 1.0", "numpy 1."], ["numpy 2.0", "numpy"]),
+        ("*", ["", "numpy", "numpy 1.0"], []),
+        ("", [""], ["numpy"]),
+        ("numpy[!-]*?( *)", ["numpyx", "numpyx 1.0"], ["numpy", "numpy-base"]),
+    ],
+)
+def test_fnmatch(pat, matches, non_matches):
+    for name in matches:
+        assert fnmatch(name, pat)
+    for name in non_matches:
+        assert not fnmatch(name, pat)
+
+
+def test_parse_dep_spec():
+    assert parse_dep_spec("numpy") == ("numpy", None, None, ("numpy",))
+    spec = parse_dep_spec("numpy >=1.21,<2.0a0 py39*")
+    assert spec.name == "numpy"
+    assert spec.version == ">=1.21,<2.0a0"
+    assert spec.build == "py39*"
+    assert spec.parts == ("numpy", ">=1.21,<2.0a0", "py39*")
+    assert parse_dep_spec("numpy >=1.21,<2.0a0 py39*") is spec
+
+
+def test_pin_transforms_are_memoized():
+    dep = "numpy >=1.21,<2.0a0 py39*"
+    _pin_stricter_dep.cache_clear()
+    new_dep = _pin_stricter_dep(dep, "x.x")
+    assert new_dep == "numpy >=1.21,<1.22.0a0 py39*"
+    assert _pin_stricter_dep(dep, "x.x") is new_dep
+    assert _pin_stricter_dep.cache_info().hits == 1
+
+    _pin_looser_dep.cache_clear()
+    new_dep = _pin_looser_dep(dep, upper_bound="3.0")
+    assert new_dep == "numpy >=1.21,<3.0a0 py39*"
+    assert _pin_looser_dep(dep, upper_bound="3.0") is new_dep
+    assert _pin_looser_dep.cache_info().hits == 1
+
+
+def test_compile_template_memoized():
+    render = _compile_template("foo >=${version},<${next_version}a0")
+    assert render is _compile_template("foo >=${version},<${next_version}a0")
+    record = {"name": "foo", "version": "1.2", "build": "h1"}
+    assert render(record, "linux-64") == "foo >=1.2,<1.3a0"
+    # only the variables used by the template are part of the memo key
+    record = {"name": "bar", "version": "1.2", "build": "h2"}
+    assert render(record, "osx-64") == "foo >=1.2,<1.3a0"
+
+    render = _compile_template("${name} ${old}", allow_old=True)
+    assert render({"name": "foo"}, None, old="bar") == "foo bar"
+    assert render({"name": "foo"}, None, old="baz") == "foo baz"
+    with pytest.raises(KeyError):
+        render({}, None, old="baz")
+
+
+def _engine_test_index(rule_set, subdir):
+    index = {}
+    for i, (patch_yaml, _) in enumerate(rule_set):
+        name = str(patch_yaml["if"].get("name", "blah")).replace("*", "x")
+        for version, timestamp in [("0.1", 0), ("1.0.0", 1600000000000)]:
+            index[f"{name}-{version}-{i}.conda"] = {
+                "name": name,
+                "version": version,
+                "build": f"py39h{i}_0",
+                "build_number": 0,
+                "timestamp": timestamp,
+                "depends": ["python >=3.9,<3.10.0a0", "numpy >=1.20,<2.0a0"],
+                "constrains": ["libblas 3.9.*"],
+                "subdir": subdir,
+            }
+        # old records can lack keys that the rules test or edit
+        index[f"{name}-0.2-{i}.tar.bz2"] = {
+            "name": name,
+            "version": "0.2",
+            "build": f"h{i}_0",
+            "build_number": 0,
+            "depends": ["python"],
+            "subdir": subdir,
+        }
+    return index
+
+
+def _patch_yaml_edit_index_per_record(index, subdir, rule_set):
+    # the original path: each rule tested and applied record by record, in
+    # rule order, skipping rules for another exact name; returns the
+    # filenames whose records made a rule raise
+    rules = []
+    for patch_yaml, _ in rule_set:
+        name = patch_yaml["if"].get("name")
+        if name is not None and CONDA_PKG_NAME_RE.match(name) is None:
+            name = None
+        rules.append((name, _compile_patch_yaml_if(patch_yaml["if"]), patch_yaml))
+
+    rules_by_name = {}
+    raised = set()
+    for fn, record in index.items():
+        if record["name"] not in rules_by_name:
+            rules_by_name[record["name"]] = [
+                (test, patch_yaml)
+                for name, test, patch_yaml in rules
+                if name is None or name == record["name"]
+            ]
+        try:
+            for test, patch_yaml in rules_by_name[record["name"]]:
+                if test(record, subdir, fn):
+                    _apply_patch_yaml(patch_yaml, record, subdir, fn)
+        except Exception:
+            raised.add(fn)
+    return raised
+
+
+def test_patch_yaml_engines_identical():
+    rule_set = RuleSet.from_patch_yamls(
+        [
+            {"if": {"name": "foo"}, "then": [{"add_depends": "bar"}]},
+            {"if": {"name": "f*"}, "then": [{"remove_depends": "bar"}]},
+            {"if": {"has_depends": "baz"}, "then": [{"add_depends": "qux"}]},
+            {"if": {"name_in": ["foo", "b*"]}, "then": [{"add_depends": "baz"}]},
+            {"if": {"has_depends": "baz"}, "then": [{"add_constrains": "qux"}]},
+            # also matches specs for other names starting with 'numpy'
+            {"if": {"has_depends": "numpy?( *)*"}, "then": [{"add_depends": "a"}]},
+            {"if": {"has_depends": "numpy?( *)x*"}, "then": [{"add_depends": "b"}]},
+        ]
+    )
+    index = {
+        "foo-1.0-0.conda": {"name": "foo", "depends": []},
+        "bar-1.0-0.conda": {"name": "bar", "depends": ["python"]},
+        "baz-1.0-0.conda": {"name": "baz", "depends": ["baz"]},
+        "qux-1.0-0.conda": {"name": "qux", "depends": ["numpyx 1.0"]},
+    }
+    expected = {
+        "foo-1.0-0.conda": {"name": "foo", "depends": ["baz"], "constrains": ["qux"]},
+        "bar-1.0-0.conda": {
+            "name": "bar",
+            "depends": ["python", "baz"],
+            "constrains": ["qux"],
+        },
+        "baz-1.0-0.conda": {
+            "name": "baz",
+            "depends": ["baz", "qux"],
+            "constrains": ["qux"],
+        },
+        "qux-1.0-0.conda": {"name": "qux", "depends": ["numpyx 1.0", "a", "b"]},
+    }
+    for engine in ["rule", "record"]:
+        _index = copy.deepcopy(index)
+        patch_yaml_edit_index(_index, "linux-64", rule_set=rule_set, engine=engine)
+        assert _index == expected
+
+    with pytest.raises(ValueError):
+        patch_yaml_edit_index(index, "linux-64", rule_set=rule_set, engine="blah")
+
+
+@pytest.mark.parametrize("subdir", ["linux-64", "osx-arm64", "win-64", "noarch"])
+def test_patch_yaml_engines_identical_on_all_rules(subdir):
+    index = _engine_test_index(DEFAULT_RULE_SET, subdir)
+    by_path = copy.deepcopy(index)
+    raised = _patch_yaml_edit_index_per_record(by_path, subdir, DEFAULT_RULE_SET)
+    # records the original path errors on must error in the engines too
+    for fn in sorted(raised):
+        for engine in ["rule", "record"]:
+            with pytest.raises(Exception):
+                patch_yaml_edit_index(
+                    {fn: copy.deepcopy(index[fn])}, subdir, engine=engine
+                )
+        del index[fn], by_path[fn]
+
+    by_rule = copy.deepcopy(index)
+    patch_yaml_edit_index(by_rule, subdir, engine="rule")
+    by_record = copy.deepcopy(index)
+    patch_yaml_edit_index(by_record, subdir, engine="record")
+    assert by_rule != index
+    assert by_rule == by_path
+    assert by_record == by_path
+
+
+def test_rule_set_compiled_for_subdir():
+    rule_set = RuleSet.from_patch_yamls(
+        [
+            {"if": {"name": "a"}, "then": [{"add_depends": "x"}]},
+            {"if": {"subdir_in": "linux-*"}, "then": [{"add_depends": "x"}]},
+            {"if": {"not_subdir_in": ["win-64"]}, "then": [{"add_depends": "x"}]},
+            {
+                "if": {"subdir_in": "*-64", "not_subdir_in": "osx-64"},
+                "then": [{"add_depends": "x"}],
+            },
+        ]
+    )
+
+    assert len(rule_set.compiled_for_subdir("linux-64")) == 4
+    assert len(rule_set.compiled_for_subdir("linux-aarch64")) == 3
+    assert rule_set.compiled_for_subdir("win-64") == [
+        rule_set.compiled[0],
+        rule_set.compiled[3],
+    ]
+    assert rule_set.compiled_for_subdir("osx-64") == [
+        rule_set.compiled[0],
+        rule_set.compiled[2],
+    ]
+
+
+def test_record_index_shortlist_artifact_in():
+    index = {
+        "a-1.0-0.conda": {"name": "a"},
+        "a-1.0-0.tar.bz2": {"name": "a"},
+        "b-1.0-0.conda": {"name": "b"},
+    }
+    record_index = _RecordIndex(index)
+    assert record_index.shortlist({"artifact_in": "a-1.0-0.conda"}) == ["a-1.0-0.conda"]
+    assert record_index.shortlist(
+        {"artifact_in": ["b-1.0-0.conda", "c-1.0-0.conda", "b-1.0-0.conda"]}
+    ) == ["b-1.0-0.conda"]
+    assert record_index.shortlist({"artifact_in": "a-1.0-0.*"}) == sorted(index)
+
+    rule_set = RuleSet.from_patch_yamls(
+        [
+            {"if": {"artifact_in": "a-1.0-0.conda"}, "then": [{"add_depends": "x"}]},
+            {"if": {"name": "a"}, "then": [{"add_depends": "y"}]},
+        ]
+    )
+    for engine in ["rule", "record"]:
+        _index = copy.deepcopy(index)
+        patch_yaml_edit_index(_index, "linux-64", rule_set=rule_set, engine=engine)
+        assert _index == {
+            "a-1.0-0.conda": {"name": "a", "depends": ["x", "y"]},
+            "a-1.0-0.tar.bz2": {"name": "a", "depends": ["y"]},
+            "b-1.0-0.conda": {"name": "b"},
+        }
+
+
+def test_record_index_plan():
+    index = {
+        f"foo-1.{i}-0.conda": {
+            "name": "foo",
+            "version": f"1.{i}",
+            "timestamp": i,
+            "depends": ["python"] if i % 2 else [],
+        }
+        for i in range(10)
+    }
+    index["bar-1.0-0.conda"] = {"name": "bar", "version": "1.0", "timestamp": 20}
+    record_index = _RecordIndex(index)
+    compiled = CompiledPatchYaml(
+        {
+            "if": {
+                "name": "foo",
+                "has_depends": "python",
+                "version": "1.*",
+                "timestamp_lt": 3,
+            },
+            "then": [{"add_depends": "x"}],
+        },
+        "foo.yaml",
+    )
+    plan = record_index.plan(compiled.patch_yaml["if"], compiled.conditions)
+    assert plan.driver == "timestamp_lt"
+    assert plan.counts == {"name": 10, "has_depends": 5, "timestamp_lt": 3}
+    assert plan.fns == [f"foo-1.{i}-0.conda" for i in range(3)]
+    # nearly every record is a foo, and the driving condition always holds
+    assert [k for k, _ in plan.conditions] == [
+        "version",
+        "has_depends",
+        "name",
+        "timestamp_lt",
+    ]
+    assert [fn for fn in plan.fns if plan.test(index[fn], "linux-64", fn)] == [
+        "foo-1.1-0.conda"
+    ]
+    assert plan.describe() == (
+        "timestamp_lt (3 candidates; has_depends=5, name=10, timestamp_lt=3) "
+        "then version, has_depends, name, timestamp_lt"
+    )
+
+    plan = record_index.plan({"version": "1.0"})
+    assert plan.driver == "scan"
+    assert plan.conditions is None
+    assert plan.fns == sorted(index)
+
+
+def test_patch_yaml_edit_index_explain(capsys, monkeypatch):
+    # explaining uses the rule engine whatever the default is
+    monkeypatch.setenv("CF_PATCH_YAML_ENGINE", "record")
+    index = {
+        "foo-1.0-0.conda": {"name": "foo", "version": "1.0"},
+        "bar-1.0-0.conda": {"name": "bar", "version": "1.0"},
+    }
+    rule_set = RuleSet.from_patch_yamls(
+        [
+            ({"if": {"name": "foo"}, "then": [{"add_depends": "x"}]}, "a/foo.yaml"),
+            ({"if": {"version": "2.0"}, "then": [{"add_depends": "y"}]}, "a/foo.yaml"),
+            ({"if": {"name": "bar"}, "then": [{"add_depends": "z"}]}, "a/bar.yaml"),
+        ]
+    )
+    patch_yaml_edit_index(index, "linux-64", rule_set=rule_set, explain=True)
+    assert index["foo-1.0-0.conda"]["depends"] == ["x"]
+    assert capsys.readouterr().err.splitlines() == [
+        "linux-64::foo.yaml: 2 rule(s)",
+        "  0: name (1 candidates; name=1) then name; 1 matched",
+        "  1: scan (2 candidates) then version; 0 matched",
+        "linux-64::bar.yaml: 1 rule(s)",
+        "  0: name (1 candidates; name=1) then name; 1 matched",
+    ]
+
+    with pytest.raises(ValueError, match="no plans"):
+        patch_yaml_edit_index(
+            index, "linux-64", rule_set=rule_set, engine="record", explain=True
+        )
+
+
+def test_patch_journal():
+    index = {
+        "foo-1.0-0.conda": {"name": "foo", "version": "1.0", "depends": ["a"]},
+        "foo-1.0-0.tar.bz2": {"name": "foo", "version": "1.0", "depends": ["a"]},
+        "bar-1.0-0.conda": {"name": "bar", "version": "1.0"},
+    }
+    rule_set = RuleSet.from_patch_yamls(
+        [
+            (
+                {"if": {"name": "foo"}, "then": [{"add_depends": "b"}]},
+                "patch_yaml/foo.yaml",
+            ),
+            (
+                {
+                    "if": {"name_in": ["foo", "bar"]},
+                    "then": [{"add_constrains": "c"}, {"remove_depends": "a"}],
+                },
+                "patch_yaml/foobar.yaml",
+            ),
+        ]
+    )
+    assert [compiled.fields for compiled in rule_set.compiled] == [
+        ["depends"],
+        ["constrains", "depends"],
+    ]
+
+    expected = [
+        ("bar-1.0-0.conda", "constrains", None, ["c"], "foobar.yaml"),
+        ("foo-1.0-0.conda", "depends", ["a"], ["a", "b"], "foo.yaml"),
+        ("foo-1.0-0.conda", "constrains", None, ["c"], "foobar.yaml"),
+        ("foo-1.0-0.conda", "depends", ["a", "b"], ["b"], "foobar.yaml"),
+        ("foo-1.0-0.tar.bz2", "depends", ["a"], ["a", "b"], "foo.yaml"),
+        ("foo-1.0-0.tar.bz2", "constrains", None, ["c"], "foobar.yaml"),
+        ("foo-1.0-0.tar.bz2", "depends", ["a", "b"], ["b"], "foobar.yaml"),
+    ]
+    for engine in ["rule", "record"]:
+        journal = PatchJournal()
+        _index = copy.deepcopy(index)
+        patch_yaml_edit_index(
+            _index, "linux-64", rule_set=rule_set, engine=engine, journal=journal
+        )
+        # the rule engine goes rule by rule, the record engine record by record
+        assert sorted(journal.entries, key=lambda entry: entry[0]) == expected
+        assert _index["bar-1.0-0.conda"]["constrains"] == ["c"]
+
+    journal = PatchJournal()
+    record = {"name": "foo", "depends": ["a"]}
+    before = journal.snapshot(record)
+    record["depends"].append("b")
+    record["license"] = "MIT"
+    journal.add_changes("foo.conda", before, record, "add_python_abi")
+    journal.add_twins({"foo.tar.bz2": "foo.conda"})
+    assert journal.to_json() == [
+        {
+            "artifact": fn,
+            "field": field,
+            "old": old,
+            "new": new,
+            "source": "add_python_abi",
+        }
+        for fn in ["foo.conda", "foo.tar.bz2"]
+        for field, old, new in [
+            ("depends", ["a"], ["a", "b"]),
+            ("license", None, "MIT"),
+        ]
+    ]
+
+
+def test_filenames_possibly_matched():
+    index = {
+        "foo-1.0-0.tar.bz2": {"name": "foo", "version": "1.0", "depends": ["a"]},
+        "foo-2.0-0.tar.bz2": {"name": "foo", "version": "2.0", "depends": []},
+        "bar-1.0-0.tar.bz2": {"name": "bar", "version": "1.0", "depends": ["a"]},
+    }
+    patched_fields = {"depends", "constrains"}
+
+    def matched(patch_yaml_if, subdir="linux-64"):
+        return filenames_possibly_matched(
+            index, subdir, [patch_yaml_if], patched_fields
+        )
+
+    assert matched({"name": "foo", "version_lt": "2"}) == {"foo-1.0-0.tar.bz2"}
+    # patches may add or remove the dependencies later
+    assert matched({"name": "foo", "has_depends": "b"}) == {
+        "foo-1.0-0.tar.bz2",
+        "foo-2.0-0.tar.bz2",
+    }
+    assert matched({"name": "foo", "not_has_depends": "a"}) == {
+        "foo-1.0-0.tar.bz2",
+        "foo-2.0-0.tar.bz2",
+    }
+    assert matched({"name": "bar", "subdir_in": "osx-64"}) == set()
+    assert matched({"name": "bar", "subdir_in": "osx-64"}, "osx-64") == {
+        "bar-1.0-0.tar.bz2"
+    }
+    # the condition raises for records without a 'license'
+    assert matched({"name": "bar", "license_in": "MIT"}) == {"bar-1.0-0.tar.bz2"}
+
+
+def test_rule_fingerprint():
+    patch_yaml = {
+        "if": {"name": "foo"},
+        "then": [{"add_depends": "a", "remove_depends": "a"}],
+    }
+    assert rule_fingerprint(patch_yaml) == rule_fingerprint(copy.deepcopy(patch_yaml))
+    # the order of the items of a 'then' block entry changes the result
+    reordered = {
+        "if": {"name": "foo"},
+        "then": [{"remove_depends": "a", "add_depends": "a"}],
+    }
+    assert rule_fingerprint(patch_yaml) != rule_fingerprint(reordered)
+
+
+def test_patch_yaml_edit_index_matches():
+    index = {
+        "foo-1.0-0.tar.bz2": {"name": "foo", "version": "1.0", "depends": []},
+        "foo-2.0-0.tar.bz2": {"name": "foo", "version": "2.0", "depends": []},
+        "bar-1.0-0.tar.bz2": {"name": "bar", "version": "1.0", "depends": []},
+    }
+    rule_set = RuleSet.from_patch_yamls(
+        [
+            ({"if": {"name": "foo"}, "then": [{"add_depends": "a"}]}, "foo.yaml"),
+            # matched records are recorded even if the rule changes nothing
+            ({"if": {"version": "1.0"}, "then": []}, "v1.yaml"),
+            ({"if": {"has_depends": "a"}, "then": [{"add_depends": "b"}]}, "v1.yaml"),
+            ({"if": {"name": "baz"}, "then": [{"add_depends": "a"}]}, "baz.yaml"),
+        ]
+    )
+    for engine in ["rule", "record"]:
+        matches = defaultdict(set)
+        patch_yaml_edit_index(
+            copy.deepcopy(index),
+            "linux-64",
+            rule_set=rule_set,
+            engine=engine,
+            matches=matches,
+        )
+        assert matches == {
+            "foo.yaml": {"foo-1.0-0.tar.bz2", "foo-2.0-0.tar.bz2"},
+            "v1.yaml": {
+                "foo-1.0-0.tar.bz2",
+                "foo-2.0-0.tar.bz2",
+                "bar-1.0-0.tar.bz2",
+            },
+        }
+
+
+def test_record_index_plan_conditions_that_raise():
+    # records without a timestamp make the 'timestamp' condition raise, so
+    # the plan must not test it before the version condition that rejects
+    # them in the order of the 'if' block
+    index = {
+        "rptools-0.1-0.tar.bz2": {"name": "rptools", "version": "0.1"},
+        "rptools-6.4.1-0.tar.bz2": {"name": "rptools", "version": "6.4.1"},
+    }
+    for i in range(20):
+        index[f"other-{i}-0.tar.bz2"] = {
+            "name": f"other{i}",
+            "version": "6.4.1",
+            "timestamp": i,
+        }
+    compiled = CompiledPatchYaml(
+        {
+            "if": {"name": "rptools", "version": "6.4.1", "timestamp": 1},
+            "then": [{"add_depends": "x"}],
+        },
+        "rptools.yaml",
+    )
+    plan = _RecordIndex(index).plan(compiled.patch_yaml["if"], compiled.conditions)
+    assert [k for k, _ in plan.conditions][0] == "timestamp"
+    fn = "rptools-0.1-0.tar.bz2"
+    assert not compiled.test(index[fn], "linux-64", fn)
+    assert not plan.test(index[fn], "linux-64", fn)
+    fn = "rptools-6.4.1-0.tar.bz2"
+    for test in [compiled.test, plan.test]:
+        with pytest.raises(KeyError):
+            test(index[fn], "linux-64", fn)
+
+    del index["rptools-6.4.1-0.tar.bz2"]
+    rule_set = RuleSet.from_patch_yamls([compiled.patch_yaml])
+    for engine in ["rule", "record"]:
+        _index = copy.deepcopy(index)
+        patch_yaml_edit_index(_index, "linux-64", rule_set=rule_set, engine=engine)
+        assert _index == index